@@ -104,11 +104,26 @@ def add_host(db: Session, inbound_tag: str, host: ProxyHostModify) -> List[Proxy
         inbound_tag (str): The tag of the inbound.
         host (ProxyHostModify): Host details to be added.
 
+    Returns:
+        List[ProxyHost]: Updated list of hosts for the inbound.
+    """
+    return add_hosts(db, inbound_tag, [host])
+
+
+def add_hosts(db: Session, inbound_tag: str, hosts: List[ProxyHostModify]) -> List[ProxyHost]:
+    """
+    Adds several hosts to a proxy inbound in a single commit.
+
+    Args:
+        db (Session): Database session.
+        inbound_tag (str): The tag of the inbound.
+        hosts (List[ProxyHostModify]): Host details to be added.
+
     Returns:
         List[ProxyHost]: Updated list of hosts for the inbound.
     """
     inbound = get_or_create_inbound(db, inbound_tag)
-    inbound.hosts.append(
+    inbound.hosts.extend(
         ProxyHost(
             remark=host.remark,
             address=host.address,
@@ -121,6 +136,7 @@ def add_host(db: Session, inbound_tag: str, host: ProxyHostModify) -> List[Proxy
             alpn=host.alpn,
             fingerprint=host.fingerprint
         )
+        for host in hosts
     )
     db.commit()
     db.refresh(inbound)
@@ -1,7 +1,8 @@
 import asyncio
 import logging
 
-from app import scheduler
+from app import app, scheduler
+from app.xpert.checker import checker
 from app.xpert.service import xpert_service
 from config import JOB_SUBSCRIPTION_AGGREGATION_INTERVAL
 
@@ -28,6 +29,12 @@ async def _update_subscriptions():
         logger.error(f"Subscription aggregation failed: {e}")
 
 
+@app.on_event("shutdown")
+async def close_xpert_http_client():
+    """Закрытие HTTP клиента подписок при остановке приложения"""
+    await checker.aclose()
+
+
 scheduler.add_job(
     run_subscription_aggregation,
     "interval",
@@ -192,7 +192,7 @@ async def get_allowed_hosts():
     """Получить все разрешенные хосты (IP и домены)"""
     try:
         from app.xpert.cluster_service import whitelist_service
-        allowed_hosts = whitelist_service.get_all_allowed_hosts()
+        allowed_hosts = whitelist_service.get_all_allowed_addresses()
         
         return {
             "hosts": list(allowed_hosts),
@@ -344,7 +344,7 @@ async def test_subscription_url(url_data: dict):
 async def sync_to_marzban():
     """Принудительная синхронизация с Marzban"""
     try:
-        result = marzban_integration.sync_active_configs_to_marzban()
+        result = await marzban_integration.sync_active_configs_to_marzban_async()
         return {"success": True, **result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -486,7 +486,7 @@ async def get_queue_configs():
 @router.get("/sub")
 async def get_subscription(format: str = "universal"):
     """Получение агрегированной подписки"""
-    content = xpert_service.generate_subscription(format)
+    content = await xpert_service.generate_subscription_async(format)
     
     headers = {
         "Content-Type": "text/plain; charset=utf-8",
@@ -1,13 +1,22 @@
-import base64
 import logging
+import os
 import random
-import secrets
-from collections import defaultdict
+import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime as dt
 from datetime import timedelta
+from functools import lru_cache
+from operator import itemgetter
+from string import Formatter
 from typing import TYPE_CHECKING, List, Literal, Union
+from urllib.parse import quote
 
-from jdatetime import date as jd
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
 
 from app import xray
 from app.utils.system import get_public_ip, get_public_ipv6, readable_size
@@ -25,26 +34,59 @@ from config import (
     EXPIRED_STATUS_TEXT,
     LIMITED_STATUS_TEXT,
     ONHOLD_STATUS_TEXT,
+    SUB_CACHE_MAX_ENTRIES,
+    SUB_CACHE_TTL,
+    XPERT_REQUIRE_ACTIVE_STATUS,
+    XPERT_USE_COUNTRY_FLAGS,
 )
 
-SERVER_IP = get_public_ip()
-SERVER_IPV6 = get_public_ipv6()
+# Публичные адреса определяются сетевым запросом: вычисляем при первом обращении
+_PUBLIC_IP_CACHE = {}
 
-STATUS_EMOJIS = {
-    "active": "✅",
-    "expired": "⌛️",
-    "limited": "🪫",
-    "disabled": "❌",
-    "on_hold": "🔌",
-}
 
-STATUS_TEXTS = {
-    "active": ACTIVE_STATUS_TEXT,
-    "expired": EXPIRED_STATUS_TEXT,
-    "limited": LIMITED_STATUS_TEXT,
-    "disabled": DISABLED_STATUS_TEXT,
-    "on_hold": ONHOLD_STATUS_TEXT,
+def _server_ip() -> str:
+    if "v4" not in _PUBLIC_IP_CACHE:
+        _PUBLIC_IP_CACHE["v4"] = get_public_ip()
+    return _PUBLIC_IP_CACHE["v4"]
+
+
+def _server_ipv6() -> str:
+    if "v6" not in _PUBLIC_IP_CACHE:
+        _PUBLIC_IP_CACHE["v6"] = get_public_ipv6()
+    return _PUBLIC_IP_CACHE["v6"]
+
+
+def __getattr__(name):
+    if name == "SERVER_IP":
+        return _server_ip()
+    if name == "SERVER_IPV6":
+        return _server_ipv6()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+_XPERT_SERVICES = None
+
+_ACTIVE_STATUSES = frozenset(("active", "on_hold"))
+
+# Готовые подписки: ключ -> (время генерации, содержимое)
+_SUBSCRIPTION_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+# Эндпоинты подписок синхронные и выполняются в пуле потоков
+_SUBSCRIPTION_CACHE_LOCK = threading.Lock()
+# Шаг округления трафика, чтобы счетчик не сбрасывал кэш на каждом байте
+_TRAFFIC_BUCKET = 10 * 1024 * 1024
+
+# Эмодзи и текст статуса: одна выборка по ключу вместо двух словарей
+STATUS = {
+    "active": ("✅", ACTIVE_STATUS_TEXT),
+    "expired": ("⌛️", EXPIRED_STATUS_TEXT),
+    "limited": ("🪫", LIMITED_STATUS_TEXT),
+    "disabled": ("❌", DISABLED_STATUS_TEXT),
+    "on_hold": ("🔌", ONHOLD_STATUS_TEXT),
 }
+_NO_STATUS = ("", "")
+
+
+# Двухбуквенный код страны в имени сервера
+_COUNTRY_CODE_RE = re.compile(r'\b([A-Z]{2})\b')
 
 
 def filter_servers_by_region(configs: list, user_ip: str = None) -> list:
@@ -66,6 +108,12 @@ def filter_servers_by_region(configs: list, user_ip: str = None) -> list:
         if not allowed_countries:  # Global - все сервера
             return configs
             
+        # Страны серверов определяются одним пакетом
+        from app.xpert.geo_service import geo_service
+        geo_service.get_country_info_batch(
+            [config.get('server', '') for config in configs if '.' in config.get('server', '')]
+        )
+        
         filtered_configs = []
         for config in configs:
             try:
@@ -80,8 +128,7 @@ def filter_servers_by_region(configs: list, user_ip: str = None) -> list:
                     country = country_info.get('code', 'UNKNOWN')
                 elif server_name:
                     # Ищем код страны в имени
-                    import re
-                    match = re.search(r'\b([A-Z]{2})\b', server_name)
+                    match = _COUNTRY_CODE_RE.search(server_name)
                     if match:
                         country = match.group(1)
                 
@@ -189,26 +236,34 @@ def create_config_from_cluster_server(server, extra_data: dict) -> str:
         return ""
 
 
+# Поля с именами серверов (name/remark/ps), в которых имя заменяется флагом страны
+_FLAG_FIELD_PATTERNS = tuple(
+    re.compile(rf'({field}="?([^"=,]+)"?)') for field in ("name", "remark", "ps")
+)
+
+
+def _flag_server_names(config_raw: str) -> list:
+    """Доменные имена серверов, для которых replace_server_names_with_flags запросит страну"""
+    names = []
+    for pattern in _FLAG_FIELD_PATTERNS:
+        for match in pattern.finditer(config_raw):
+            server_name = match.group(2)
+            if server_name.isascii() and '.' in server_name and not server_name.startswith('http'):
+                names.append(server_name.split(':')[0])
+    return names
+
+
 def replace_server_names_with_flags(config_raw: str) -> str:
     try:
-        import config as app_config
-        
         # Если флаги отключены в настройках, возвращаем как есть
-        if not app_config.XPERT_USE_COUNTRY_FLAGS:
+        if not XPERT_USE_COUNTRY_FLAGS:
             logger.info("Country flags disabled in config, returning original")
             return config_raw
             
         from app.xpert.geo_service import geo_service
-        import re
-        import logging
-        import urllib.parse
-        logger = logging.getLogger(__name__)
         
         logger.info(f"Processing config for flags replacement, length: {len(config_raw)}")
         
-        # Регулярное выражение для поиска имен серверов в различных форматах
-        name_pattern = r'(name="?([^"=,]+)"?)'
-        
         def replace_name(match):
             full_match = match.group(1)
             server_name = match.group(2)
@@ -216,7 +271,7 @@ def replace_server_names_with_flags(config_raw: str) -> str:
             logger.debug(f"Processing server name: {server_name}")
             
             # Если имя уже содержит флаг (emoji), не меняем его
-            if any(ord(char) > 127 for char in server_name):
+            if not server_name.isascii():
                 logger.debug(f"Server {server_name} already has flag, skipping")
                 return full_match
             
@@ -228,7 +283,7 @@ def replace_server_names_with_flags(config_raw: str) -> str:
                     code = country_info['code']
                     
                     # Конвертируем emoji в UTF-8 URL-encoded для Happ
-                    flag_encoded = urllib.parse.quote(flag.encode('utf-8'))
+                    flag_encoded = quote(flag.encode('utf-8'))
                     new_name = f"{flag_encoded} {code}"
                     
                     logger.info(f"Replaced '{server_name}' with '{new_name}' (flag: {flag})")
@@ -241,20 +296,10 @@ def replace_server_names_with_flags(config_raw: str) -> str:
             # Если не удалось определить, оставляем как есть
             return full_match
         
-        # Применяем замену
-        result = re.sub(name_pattern, replace_name, config_raw)
-        
-        # Дополнительная обработка для remark полей
-        remark_pattern = r'(remark="?([^"=,]+)"?)'
-        result = re.sub(remark_pattern, replace_name, result)
-        
-        # Дополнительная обработка для других полей
-        other_patterns = [
-            r'(ps="?([^"=,]+)"?)',  # ps field
-        ]
-        
-        for pattern in other_patterns:
-            result = re.sub(pattern, replace_name, result)
+        # Применяем замену для name, remark и ps полей
+        result = config_raw
+        for pattern in _FLAG_FIELD_PATTERNS:
+            result = pattern.sub(replace_name, result)
         
         logger.info(f"Processed config with Happ-compatible flags")
         return result
@@ -267,51 +312,51 @@ def replace_server_names_with_flags(config_raw: str) -> str:
         return config_raw
 
 
-def generate_v2ray_links(proxies: dict, inbounds: dict, extra_data: dict, reverse: bool) -> list:
-    format_variables = setup_format_variables(extra_data)
-    conf = V2rayShareLink()
-    
-    # Проверяем статус пользователя для фильтрации сторонних серверов
-    user_status = extra_data.get('status', '')
-    data_limit = extra_data.get('data_limit', 0)
-    used_traffic = extra_data.get('used_traffic', 0)
-    expire = extra_data.get('expire', 0)
-    
-    # Определяем, нужно ли скрывать сторонние сервера
-    hide_external_servers = False
-    import config as app_config
-    
-    # Если пользователь неактивен - скрываем сторонние сервера
-    if user_status not in ['active', 'on_hold']:
-        hide_external_servers = True
-    
-    # Если закончился трафик - скрываем сторонние сервера  
-    if data_limit is not None and data_limit > 0 and used_traffic >= data_limit:
-        hide_external_servers = True
-        
-    # Если истек срок - скрываем сторонние сервера
-    if expire is not None and expire > 0 and expire <= 0:
-        hide_external_servers = True
-    
-    # Добавляем обычные конфиги Marzban (только если не скрыты)
-    if not hide_external_servers:
-        marzban_links = process_inbounds_and_tags(inbounds, proxies, format_variables, conf=conf, reverse=reverse)
-    else:
-        # Если пользователь неактивен, добавляем только заглушку или пусто
-        pass
-    
-    # Добавляем конфиги из Xpert Panel (с автоматической синхронизацией)
-    try:
+def _get_xpert_services() -> tuple:
+    """Xpert-сервисы импортируются один раз при первом вызове: этот модуль импортируется из app.models.user"""
+    global _XPERT_SERVICES
+    if _XPERT_SERVICES is None:
         from app.xpert.service import xpert_service
         from app.xpert.cluster_service import whitelist_service
         from app.xpert.ip_filter import host_filter
         from app.xpert.marzban_integration import marzban_integration
+
+        _XPERT_SERVICES = (xpert_service, whitelist_service, host_filter, marzban_integration)
+    return _XPERT_SERVICES
+
+
+def _apply_flag_to_remark(remark: str) -> str:
+    """Заменяет имя сервера в remark на флаг страны"""
+    flag_remark = replace_server_names_with_flags(f"name={remark}")
+    # Извлекаем только имя с флагом
+    return flag_remark.replace("name=", "").strip('"')
+
+
+def _is_user_active(extra_data: dict) -> bool:
+    """Активен ли пользователь: статус, остаток трафика и срок действия"""
+    if extra_data.get('status') not in _ACTIVE_STATUSES:
+        return False
+
+    data_limit = extra_data.get('data_limit')
+    if data_limit and (extra_data.get('used_traffic') or 0) >= data_limit:
+        return False
+
+    expire = extra_data.get('expire')
+    if expire is not None and 0 < expire <= time.time():
+        return False
+
+    return True
+
+
+def _select_xpert_links() -> list:
+    """Ссылки Xpert Panel, прошедшие фильтр разрешенных хостов (с флагами стран)"""
+    try:
+        xpert_service, whitelist_service, host_filter, marzban_integration = _get_xpert_services()
         
         # Автоматическая синхронизация с Marzban при генерации подписки
         # Это гарантирует что Xpert конфиги всегда доступны в Marzban
         try:
             # Проверяем нужно ли синхронизировать (раз в час)
-            import time
             current_time = time.time()
             
             # Получаем время последней синхронизации из кэша или файла
@@ -325,49 +370,53 @@ def generate_v2ray_links(proxies: dict, inbounds: dict, extra_data: dict, revers
             logger.warning(f"Auto-sync failed: {sync_error}")
         
         # Получаем разрешенные хосты
-        allowed_hosts = whitelist_service.get_all_allowed_hosts()
+        allowed_hosts = whitelist_service.get_all_allowed_addresses()
         logger.info(f"Found {len(allowed_hosts)} allowed hosts in whitelist")
         
         # Получаем все конфиги из Xpert
-        if not app_config.XPERT_REQUIRE_ACTIVE_STATUS:
-            xpert_configs = xpert_service.get_active_configs()
-        else:
-            # Если пользователь неактивен, не добавляем Xpert конфиги
-            if user_status not in ['active', 'on_hold']:
-                return conf.render(reverse=reverse)
-                
-            # Если закончился трафик, не добавляем Xpert конфиги
-            if data_limit is not None and data_limit > 0 and used_traffic >= data_limit:
-                return conf.render(reverse=reverse)
-                
-            # Если истек срок, не добавляем Xpert конфиги
-            if expire is not None and expire > 0 and expire <= 0:
-                return conf.render(reverse=reverse)
-            
-            xpert_configs = xpert_service.get_active_configs()
+        xpert_configs = xpert_service.get_active_configs()
+        if not xpert_configs:
+            return []
         
         # ВСЕГДА фильтруем сервера по разрешенным хостам
-        if xpert_configs:
-            server_configs = [config.raw for config in xpert_configs]
-            logger.info(f"Processing {len(server_configs)} Xpert servers")
-            
-            if server_configs:
-                logger.info(f"Filtering {len(server_configs)} servers by allowed hosts")
-                
-                # Фильтрация серверов
-                filtered_configs = host_filter.filter_servers(server_configs)
-                
-                logger.info(f"Filtered result: {len(filtered_configs)}/{len(server_configs)} servers allowed")
-                
-                # Добавляем только разрешенные конфиги
-                for config_raw in filtered_configs:
-                    config_with_flags = replace_server_names_with_flags(config_raw)
-                    conf.add_link(config_with_flags)
-                    
+        server_configs = [config.raw for config in xpert_configs]
+        logger.info(f"Filtering {len(server_configs)} Xpert servers by allowed hosts")
+        
+        filtered_configs = host_filter.filter_servers(server_configs)
+        logger.info(f"Filtered result: {len(filtered_configs)}/{len(server_configs)} servers allowed")
+        
+        if XPERT_USE_COUNTRY_FLAGS:
+            # Страны всех серверов определяются одним пакетом до замены имен
+            from app.xpert.geo_service import geo_service
+            geo_service.get_country_info_batch(
+                [name for config_raw in filtered_configs for name in _flag_server_names(config_raw)]
+            )
+        
+        return [replace_server_names_with_flags(config_raw) for config_raw in filtered_configs]
+        
     except Exception as e:
         # Если Xpert Panel не настроен, просто игнорируем
         logger.debug(f"Xpert Panel integration failed: {e}")
-        pass
+        return []
+
+
+def generate_v2ray_links(proxies: dict, inbounds: dict, extra_data: dict, reverse: bool) -> list:
+    format_variables = setup_format_variables(extra_data)
+    conf = V2rayShareLink()
+    
+    # Скрываем сторонние сервера, если пользователь неактивен, закончился трафик или истек срок
+    hide_external_servers = not _is_user_active(extra_data)
+
+    # Добавляем обычные конфиги Marzban (только если не скрыты)
+    if not hide_external_servers:
+        process_inbounds_and_tags(
+            inbounds, proxies, format_variables, conf=conf, reverse=reverse, apply_flags=True
+        )
+
+    # Добавляем конфиги из Xpert Panel; неактивным пользователям - только если это не запрещено
+    if not hide_external_servers or not XPERT_REQUIRE_ACTIVE_STATUS:
+        for link in _select_xpert_links():
+            conf.add_link(link)
     
     return conf.render(reverse=reverse)
 
@@ -426,11 +475,55 @@ def generate_v2ray_json_subscription(
     )
 
 
+def _subscription_cache_key(user: "UserResponse", config_format: str, as_base64: bool, reverse: bool) -> tuple:
+    return (
+        user.username,
+        config_format,
+        as_base64,
+        reverse,
+        user.status,
+        user.expire,
+        user.data_limit,
+        user.on_hold_expire_duration,
+        (user.used_traffic or 0) // _TRAFFIC_BUCKET,
+        repr(user.proxies),
+        repr(user.inbounds),
+    )
+
+
 def generate_subscription(
         user: "UserResponse",
         config_format: Literal["v2ray", "clash-meta", "clash", "sing-box", "outline", "v2ray-json"],
         as_base64: bool,
         reverse: bool,
+) -> str:
+    if SUB_CACHE_TTL <= 0:
+        return _generate_subscription(user, config_format, as_base64, reverse)
+
+    key = _subscription_cache_key(user, config_format, as_base64, reverse)
+    now = time.monotonic()
+    with _SUBSCRIPTION_CACHE_LOCK:
+        cached = _SUBSCRIPTION_CACHE.get(key)
+        if cached and now - cached[0] < SUB_CACHE_TTL:
+            _SUBSCRIPTION_CACHE.move_to_end(key)
+            return cached[1]
+
+    config = _generate_subscription(user, config_format, as_base64, reverse)
+
+    with _SUBSCRIPTION_CACHE_LOCK:
+        _SUBSCRIPTION_CACHE[key] = (now, config)
+        _SUBSCRIPTION_CACHE.move_to_end(key)
+        while len(_SUBSCRIPTION_CACHE) > SUB_CACHE_MAX_ENTRIES:
+            _SUBSCRIPTION_CACHE.popitem(last=False)
+
+    return config
+
+
+def _generate_subscription(
+        user: "UserResponse",
+        config_format: str,
+        as_base64: bool,
+        reverse: bool,
 ) -> str:
     kwargs = {
         "proxies": user.proxies,
@@ -475,7 +568,7 @@ def generate_subscription(
             logger.error(f"Failed to add routing to subscription: {e}")
 
     if as_base64:
-        config = base64.b64encode(config.encode()).decode()
+        config = b64encode(config.encode("utf-8")).decode("ascii")
 
     return config
 
@@ -484,23 +577,62 @@ def format_time_left(seconds_left: int) -> str:
     if not seconds_left or seconds_left <= 0:
         return "∞"
 
-    minutes, seconds = divmod(seconds_left, 60)
-    hours, minutes = divmod(minutes, 60)
-    days, hours = divmod(hours, 24)
-    months, days = divmod(days, 30)
-
+    # Каскад от крупных единиц: при днях/месяцах минуты и секунды не вычисляются вовсе
+    total_days, rest = divmod(seconds_left, 86400)
+    if total_days:
+        months, days = divmod(total_days, 30)
+        head = f"{months}m {days}d" if months and days else (f"{months}m" if months else f"{days}d")
+        if days < 7 and rest >= 3600:
+            return f"{head} {rest // 3600}h"
+        return head
+
+    hours, rest = divmod(rest, 3600)
+    minutes, seconds = divmod(rest, 60)
     result = []
-    if months:
-        result.append(f"{months}m")
-    if days:
-        result.append(f"{days}d")
-    if hours and (days < 7):
+    if hours:
         result.append(f"{hours}h")
-    if minutes and not (months or days):
+    if minutes:
         result.append(f"{minutes}m")
-    if seconds and not (months or days):
+    if seconds:
         result.append(f"{seconds}s")
-    return " ".join(result)
+    return " ".join(result) or "0s"
+
+
+class _MissingDict(dict):
+    __slots__ = ("jalali_expire_timestamp",)
+
+    def __init__(self, *args, jalali_expire_timestamp: int = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.jalali_expire_timestamp = jalali_expire_timestamp
+
+    def __missing__(self, key):
+        # Дату по джалали и публичные IP считаем только если шаблон их использует
+        if key == "JALALI_EXPIRE_DATE" and self.jalali_expire_timestamp is not None:
+            value = self[key] = _jalali_expire_date(self.jalali_expire_timestamp)
+            return value
+        if key == "SERVER_IP":
+            value = self[key] = _server_ip()
+            return value
+        if key == "SERVER_IPV6":
+            value = self[key] = _server_ipv6()
+            return value
+        return "<missing>"
+
+
+@lru_cache(maxsize=8192)
+def _expire_date(expire_timestamp: int) -> str:
+    return dt.fromtimestamp(expire_timestamp).date().isoformat()
+
+
+@lru_cache(maxsize=8192)
+def _jalali_expire_date(expire_timestamp: int) -> str:
+    expire_date = dt.fromtimestamp(expire_timestamp).date()
+    # jdatetime нужен только шаблонам с JALALI_EXPIRE_DATE, не грузим его при импорте
+    from jdatetime import date as jd
+
+    return jd.fromgregorian(
+        year=expire_date.year, month=expire_date.month, day=expire_date.day
+    ).strftime("%Y-%m-%d")
 
 
 def setup_format_variables(extra_data: dict) -> dict:
@@ -511,17 +643,16 @@ def setup_format_variables(extra_data: dict) -> dict:
     on_hold_expire_duration = extra_data.get("on_hold_expire_duration")
     now = dt.utcnow()
     now_ts = now.timestamp()
+    # Дата по джалали вычисляется лениво в _MissingDict.__missing__
+    jalali_expire_timestamp = None
 
     if user_status != UserStatus.on_hold:
         if expire_timestamp is not None and expire_timestamp >= 0:
-            seconds_left = expire_timestamp - int(dt.utcnow().timestamp())
-            expire_datetime = dt.fromtimestamp(expire_timestamp)
-            expire_date = expire_datetime.date()
-            jalali_expire_date = jd.fromgregorian(
-                year=expire_date.year, month=expire_date.month, day=expire_date.day
-            ).strftime("%Y-%m-%d")
+            seconds_left = expire_timestamp - int(now_ts)
+            expire_date = _expire_date(expire_timestamp)
+            jalali_expire_timestamp = expire_timestamp
             if now_ts < expire_timestamp:
-                days_left = (expire_datetime - dt.utcnow()).days + 1
+                days_left = (dt.fromtimestamp(expire_timestamp) - now).days + 1
                 time_left = format_time_left(seconds_left)
             else:
                 days_left = "0"
@@ -554,30 +685,91 @@ def setup_format_variables(extra_data: dict) -> dict:
         data_limit = "∞"
         data_left = "∞"
 
-    status_emoji = STATUS_EMOJIS.get(extra_data.get("status")) or ""
-    status_text = STATUS_TEXTS.get(extra_data.get("status")) or ""
+    status_emoji, status_text = STATUS.get(user_status, _NO_STATUS)
+    status_text = status_text or ""
 
-    format_variables = defaultdict(
-        lambda: "<missing>",
+    format_variables = _MissingDict(
         {
-            "SERVER_IP": SERVER_IP,
-            "SERVER_IPV6": SERVER_IPV6,
             "USERNAME": extra_data.get("username", "{USERNAME}"),
             "DATA_USAGE": readable_size(extra_data.get("used_traffic")),
             "DATA_LIMIT": data_limit,
             "DATA_LEFT": data_left,
             "DAYS_LEFT": days_left,
             "EXPIRE_DATE": expire_date,
-            "JALALI_EXPIRE_DATE": jalali_expire_date,
             "TIME_LEFT": time_left,
             "STATUS_EMOJI": status_emoji,
             "STATUS_TEXT": status_text,
         },
+        jalali_expire_timestamp=jalali_expire_timestamp,
     )
+    if jalali_expire_timestamp is None:
+        format_variables["JALALI_EXPIRE_DATE"] = jalali_expire_date
 
     return format_variables
 
 
+_FORMATTER = Formatter()
+
+# Порядок inbound'ов из конфига Xray: пересчитывается только при перезагрузке конфига
+_TAG_INDEX_CACHE = {"inbounds_by_tag": None, "size": 0, "index": {}}
+
+
+class _CompiledTemplate:
+    __slots__ = ("parts",)
+
+    def __init__(self, parts: tuple):
+        self.parts = parts
+
+    def render(self, mapping: dict) -> str:
+        result = []
+        for literal, field_name, format_spec, conversion in self.parts:
+            if literal:
+                result.append(literal)
+            if field_name is not None:
+                value = mapping[field_name]
+                if conversion == "r":
+                    value = repr(value)
+                elif conversion == "a":
+                    value = ascii(value)
+                elif conversion == "s":
+                    value = str(value)
+                result.append(format(value, format_spec))
+        return "".join(result)
+
+
+@lru_cache(maxsize=1024)
+def _compile_template(template: str):
+    parts = []
+    for literal, field_name, format_spec, conversion in _FORMATTER.parse(template):
+        if field_name is not None and (
+            not field_name or "." in field_name or "[" in field_name or "{" in (format_spec or "")
+        ):
+            # Позиционные, составные и вложенные поля оставляем на format_map
+            return None
+        parts.append((literal, field_name, format_spec, conversion))
+    return _CompiledTemplate(tuple(parts))
+
+
+def _render(template: str, mapping: dict) -> str:
+    # Большинство remark/path/address — константы: отдаем их без разбора шаблона
+    if "{" not in template and "}" not in template:
+        return template
+
+    compiled = _compile_template(template)
+    if compiled is None:
+        return template.format_map(mapping)
+    return compiled.render(mapping)
+
+
+def _get_tag_index(inbounds_by_tag: dict) -> dict:
+    cache = _TAG_INDEX_CACHE
+    if cache["inbounds_by_tag"] is not inbounds_by_tag or cache["size"] != len(inbounds_by_tag):
+        cache["index"] = {tag: index for index, tag in enumerate(inbounds_by_tag.keys())}
+        cache["inbounds_by_tag"] = inbounds_by_tag
+        cache["size"] = len(inbounds_by_tag)
+    return cache["index"]
+
+
 def process_inbounds_and_tags(
         inbounds: dict,
         proxies: dict,
@@ -591,92 +783,105 @@ def process_inbounds_and_tags(
             OutlineConfiguration
         ],
         reverse=False,
+        apply_flags: bool = False,
 ) -> Union[List, str]:
-    _inbounds = []
-    for protocol, tags in inbounds.items():
-        for tag in tags:
-            _inbounds.append((protocol, [tag]))
-    index_dict = {proxy: index for index, proxy in enumerate(
-        xray.config.inbounds_by_tag.keys())}
-    inbounds = sorted(
-        _inbounds, key=lambda x: index_dict.get(x[1][0], float('inf')))
-
-    for protocol, tags in inbounds:
+    inbounds_by_tag = xray.config.inbounds_by_tag
+    get_hosts = xray.hosts.get
+    update_variables = format_variables.update
+    choice = random.choice
+
+    index_dict = _get_tag_index(inbounds_by_tag)
+    unknown_index = len(index_dict)
+    _inbounds = [
+        (index_dict.get(tag, unknown_index), protocol, [tag])
+        for protocol, tags in inbounds.items()
+        for tag in tags
+    ]
+    _inbounds.sort(key=itemgetter(0))
+
+    # Соль для wildcard-значений: один вызов os.urandom на всю подписку (до 3 солей по 8 байт на хост)
+    host_count = sum(len(get_hosts(tags[0], ())) for _, _, tags in _inbounds)
+    salts = os.urandom(24 * host_count).hex()
+    salt_pos = 0
+
+    for _, protocol, tags in _inbounds:
         settings = proxies.get(protocol)
         if not settings:
             continue
+        # Форматы только читают настройки прокси: сериализуем один раз на протокол, а не на каждый хост
+        settings_dump = settings.model_dump()
 
-        format_variables.update({"PROTOCOL": protocol.name})
+        update_variables({"PROTOCOL": protocol.name})
         for tag in tags:
-            inbound = xray.config.inbounds_by_tag.get(tag)
+            inbound = inbounds_by_tag.get(tag)
             if not inbound:
                 continue
 
-            format_variables.update({"TRANSPORT": inbound["network"]})
+            update_variables({"TRANSPORT": inbound["network"]})
+            # Один рабочий словарь на inbound: conf.add читает значения сразу и не хранит ссылку,
+            # а все зависящие от хоста ключи перезаписываются на каждой итерации
             host_inbound = inbound.copy()
-            for host in xray.hosts.get(tag, []):
+            for host in get_hosts(tag, []):
                 sni = ""
                 sni_list = host["sni"] or inbound["sni"]
                 if sni_list:
-                    salt = secrets.token_hex(8)
-                    sni = random.choice(sni_list).replace("*", salt)
+                    salt = salts[salt_pos:salt_pos + 16]
+                    salt_pos += 16
+                    sni = choice(sni_list).replace("*", salt)
 
                 if sids := inbound.get("sids"):
-                    inbound["sid"] = random.choice(sids)
+                    host_inbound["sid"] = choice(sids)
 
                 req_host = ""
                 req_host_list = host["host"] or inbound["host"]
                 if req_host_list:
-                    salt = secrets.token_hex(8)
-                    req_host = random.choice(req_host_list).replace("*", salt)
+                    salt = salts[salt_pos:salt_pos + 16]
+                    salt_pos += 16
+                    req_host = choice(req_host_list).replace("*", salt)
 
                 address = ""
                 address_list = host['address']
                 if host['address']:
-                    salt = secrets.token_hex(8)
-                    address = random.choice(address_list).replace('*', salt)
+                    # Подставляем переменные до соли, чтобы кэш шаблонов не засорялся случайными строками
+                    salt = salts[salt_pos:salt_pos + 16]
+                    salt_pos += 16
+                    address = _render(choice(address_list), format_variables).replace('*', salt)
 
                 if host["path"] is not None:
-                    path = host["path"].format_map(format_variables)
+                    path = _render(host["path"], format_variables)
                 else:
-                    path = inbound.get("path", "").format_map(format_variables)
+                    path = _render(inbound.get("path", ""), format_variables)
 
                 if host.get("use_sni_as_host", False) and sni:
                     req_host = sni
 
-                host_inbound.update(
-                    {
-                        "port": host["port"] or inbound["port"],
-                        "sni": sni,
-                        "host": req_host,
-                        "tls": inbound["tls"] if host["tls"] is None else host["tls"],
-                        "alpn": host["alpn"] if host["alpn"] else None,
-                        "path": path,
-                        "fp": host["fingerprint"] or inbound.get("fp", ""),
-                        "ais": host["allowinsecure"]
-                        or inbound.get("allowinsecure", ""),
-                        "mux_enable": host["mux_enable"],
-                        "fragment_setting": host["fragment_setting"],
-                        "noise_setting": host["noise_setting"],
-                        "random_user_agent": host["random_user_agent"],
-                    }
-                )
+                # Ключи пишутся напрямую: без временного словаря и без роста таблицы после первого хоста
+                host_inbound["port"] = host["port"] or inbound["port"]
+                host_inbound["sni"] = sni
+                host_inbound["host"] = req_host
+                host_inbound["tls"] = inbound["tls"] if host["tls"] is None else host["tls"]
+                host_inbound["alpn"] = host["alpn"] if host["alpn"] else None
+                host_inbound["path"] = path
+                host_inbound["fp"] = host["fingerprint"] or inbound.get("fp", "")
+                host_inbound["ais"] = host["allowinsecure"] or inbound.get("allowinsecure", "")
+                host_inbound["mux_enable"] = host["mux_enable"]
+                host_inbound["fragment_setting"] = host["fragment_setting"]
+                host_inbound["noise_setting"] = host["noise_setting"]
+                host_inbound["random_user_agent"] = host["random_user_agent"]
+
+                # Заменяем имя сервера на флаг страны (только для share-ссылок v2ray)
+                original_remark = _render(host["remark"], format_variables)
+                flag_remark = _apply_flag_to_remark(original_remark) if apply_flags else original_remark
 
-                # Заменяем имя сервера на флаг страны
-                original_remark = host["remark"].format_map(format_variables)
-                flag_remark = replace_server_names_with_flags(f"name={original_remark}")
-                # Извлекаем только имя с флагом
-                flag_remark = flag_remark.replace("name=", "").strip('"')
-                
                 conf.add(
                     remark=flag_remark,
-                    address=address.format_map(format_variables),
+                    address=address,
                     inbound=host_inbound,
-                    settings=settings.model_dump()
+                    settings=settings_dump
                 )
 
     return conf.render(reverse=reverse)
 
 
 def encode_title(text: str) -> str:
-    return f"base64:{base64.b64encode(text.encode()).decode()}"
+    return f"base64:{b64encode(text.encode('utf-8')).decode('ascii')}"
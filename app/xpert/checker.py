@@ -1,18 +1,92 @@
 import asyncio
-import base64
+import binascii
+import codecs
+import importlib.util
+import ipaddress
+import json
 import re
 import socket
-import subprocess
+import ssl
 import time
 import logging
+import weakref
+from functools import lru_cache
 from typing import List, Tuple, Optional
-from urllib.parse import urlparse, parse_qs, unquote
+from urllib.parse import unquote
 import httpx
 
+try:
+    from pybase64 import b64decode, urlsafe_b64decode
+except ImportError:
+    from base64 import b64decode, urlsafe_b64decode
+
+# httpx поддерживает HTTP/2 только при установленном h2
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+try:
+    from icmplib import async_ping, ICMPLibError, SocketPermissionError
+except ImportError:
+    async_ping = None
+
 import config
 
 logger = logging.getLogger(__name__)
 
+# Время жизни записей DNS кэша проверок (секунды)
+_DNS_TTL = 300
+# Время жизни результатов check_port (секунды)
+_PORT_CACHE_TTL = 30
+# Предел записей DNS кэша и кэшей проверок портов: при переполнении устаревшие записи удаляются
+_CHECK_CACHE_SIZE = 10000
+# Очередь конфигов между загрузкой подписки и обработкой: ограничивает число строк в ожидании
+_PIPELINE_QUEUE_SIZE = 256
+
+# Строка подписки с конфигом поддерживаемого протокола (без окружающих пробелов)
+_CONFIG_LINE_RE = re.compile(r'^[ \t]*((?:vless|vmess|trojan|ss|ssr)://[^\r\n]*?)[ \t\r]*$', re.MULTILINE)
+# Признак готовых конфигов в теле подписки (один проход вместо пяти поисков подстроки)
+_PROTO_SEARCH_RE = re.compile(rb'(?:vless|vmess|trojan|ss|ssr)://')
+# host/port/fragment из URI вида scheme://[userinfo@]host[:port][/path][?query][#fragment]
+_URI_RE = re.compile(
+    r'^[A-Za-z][A-Za-z0-9+.-]*://(?:[^/?#]*@)?'
+    r'(?:\[(?P<host6>[^\]/?#]*)\]|(?P<host>[^:/?#]*))'
+    r'(?::(?P<port>\d*))?(?:[/?][^#]*)?(?:#(?P<frag>.*))?$',
+    re.DOTALL,
+)
+
+def _pad_b64(encoded: bytes) -> bytes:
+    """Дополняет base64 до кратной 4 длины без ветвлений"""
+    return encoded + b"=" * (-len(encoded) & 3)
+
+
+def _prune_cache(cache: dict, is_fresh) -> None:
+    """Удаляет устаревшие записи переполненного кэша, а если их нет - очищает его целиком"""
+    if len(cache) < _CHECK_CACHE_SIZE:
+        return
+    for key in [key for key, value in cache.items() if not is_fresh(value)]:
+        del cache[key]
+    if len(cache) >= _CHECK_CACHE_SIZE:
+        cache.clear()
+
+
+# Провайдеры повторяют одни и те же имена во фрагментах множества конфигов
+_unquote_fragment = lru_cache(maxsize=4096)(unquote)
+
+# Начало тела подписки в base64 (алфавит base64 и переводы строк)
+_BASE64_PREFIX_RE = re.compile(rb'[A-Za-z0-9+/=\s]+')
+# Сколько байт тела подписки читается до выбора формата (готовые конфиги или base64)
+_SNIFF_SIZE = 4096
+# Размер блока при потоковом чтении подписки
+_STREAM_CHUNK_SIZE = 65536
+
+# Улучшенные заголовки для GitHub и других сервисов
+_SUBSCRIPTION_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept": "text/plain, application/octet-stream, */*",
+    "Accept-Encoding": "gzip, deflate",
+    "Cache-Control": "no-cache",
+    "Pragma": "no-cache"
+}
+
 
 class ConfigChecker:
     """Проверка и парсинг VPN конфигураций"""
@@ -21,55 +95,71 @@ class ConfigChecker:
         self.max_ping = config.XPERT_MAX_PING_MS
         self.target_ips = config.XPERT_TARGET_CHECK_IPS
         self.timeout = 3
+        # Одни и те же строки разбираются многократно (обновление, фильтрация, подписки)
+        self._parse_cached = lru_cache(maxsize=4096)(self._parse_config)
+        # схема URI -> (имя протокола, парсер)
+        self._parsers = {
+            "vless": ("vless", self._parse_vless),
+            "vmess": ("vmess", self._parse_vmess),
+            "trojan": ("trojan", self._parse_trojan),
+            "ss": ("shadowsocks", self._parse_shadowsocks),
+            "ssr": ("ssr", self._parse_ssr),
+        }
+        # Общий HTTP клиент на каждый event loop: пул соединений и SSL контекст переиспользуются между загрузками
+        self._clients = weakref.WeakKeyDictionary()
+        # TLS для проверки рукопожатием: сертификат не проверяем, как и в HTTP клиенте
+        self._probe_ssl_context = ssl.create_default_context()
+        self._probe_ssl_context.check_hostname = False
+        self._probe_ssl_context.verify_mode = ssl.CERT_NONE
+        # host -> (ip, время истечения): конфиги одной подписки часто делят домены CDN
+        self._dns_cache = {}
+        # (host, port) -> (доступен, время проверки): один сервер часто стоит за многими конфигами
+        self._port_cache = {}
+        # (host, port) -> ((доступен, время соединения), время проверки)
+        self._connectivity_cache = {}
+        # ICMP без root требует net.ipv4.ping_group_range; без него остаются TCP замеры
+        self._icmp_available = async_ping is not None
     
     def parse_config(self, raw: str) -> Tuple[str, str, int, str]:
         """Парсинг конфигурации VPN"""
-        raw = raw.strip()
-        protocol = ""
+        return self._parse_cached(raw.strip())
+    
+    def _parse_config(self, raw: str) -> Tuple[str, str, int, str]:
         server = ""
         port = 0
         remarks = ""
         
-        try:
-            if raw.startswith("vless://"):
-                protocol = "vless"
-                server, port, remarks = self._parse_vless(raw)
-            elif raw.startswith("vmess://"):
-                protocol = "vmess"
-                server, port, remarks = self._parse_vmess(raw)
-            elif raw.startswith("trojan://"):
-                protocol = "trojan"
-                server, port, remarks = self._parse_trojan(raw)
-            elif raw.startswith("ss://"):
-                protocol = "shadowsocks"
-                server, port, remarks = self._parse_shadowsocks(raw)
-            elif raw.startswith("ssr://"):
-                protocol = "ssr"
-                server, port, remarks = self._parse_ssr(raw)
-        except Exception as e:
-            logger.debug(f"Failed to parse config: {e}")
+        # Схема определяет парсер одной выборкой из словаря вместо цепочки startswith
+        scheme, sep, _ = raw.partition("://")
+        protocol, parser = self._parsers.get(scheme, ("", None)) if sep else ("", None)
+        if parser is not None:
+            try:
+                server, port, remarks = parser(raw)
+            except Exception as e:
+                logger.debug(f"Failed to parse config: {e}")
         
         return protocol, server, port, remarks
     
-    def _parse_vless(self, raw: str) -> Tuple[str, int, str]:
-        try:
-            parsed = urlparse(raw)
-            server = parsed.hostname or ""
-            port = parsed.port or 443
-            remarks = unquote(parsed.fragment) if parsed.fragment else ""
-            return server, port, remarks
-        except:
+    def _parse_uri(self, raw: str) -> Tuple[str, int, str]:
+        """Разбор host/port/remarks одним регулярным выражением вместо urlparse"""
+        match = _URI_RE.match(raw)
+        if not match:
+            return "", 0, ""
+        server = (match["host6"] or match["host"] or "").lower()
+        port = int(match["port"]) if match["port"] else 0
+        if port > 65535:
             return "", 0, ""
+        frag = match["frag"]
+        return server, port or 443, _unquote_fragment(frag) if frag else ""
+    
+    def _parse_vless(self, raw: str) -> Tuple[str, int, str]:
+        return self._parse_uri(raw)
     
     def _parse_vmess(self, raw: str) -> Tuple[str, int, str]:
         try:
-            import json
-            encoded = raw.replace("vmess://", "")
-            padding = 4 - len(encoded) % 4
-            if padding != 4:
-                encoded += "=" * padding
-            decoded = base64.b64decode(encoded).decode('utf-8')
-            data = json.loads(decoded)
+            # Работаем с bytes: b64decode не перекодирует строку, json.loads принимает bytes
+            encoded = raw.encode('ascii', 'ignore').removeprefix(b"vmess://")
+            data = json.loads(b64decode(_pad_b64(encoded)))
             server = data.get("add", "")
             port = int(data.get("port", 443))
             remarks = data.get("ps", "")
@@ -78,32 +168,15 @@ class ConfigChecker:
             return "", 0, ""
     
     def _parse_trojan(self, raw: str) -> Tuple[str, int, str]:
-        try:
-            parsed = urlparse(raw)
-            server = parsed.hostname or ""
-            port = parsed.port or 443
-            remarks = unquote(parsed.fragment) if parsed.fragment else ""
-            return server, port, remarks
-        except:
-            return "", 0, ""
+        return self._parse_uri(raw)
     
     def _parse_shadowsocks(self, raw: str) -> Tuple[str, int, str]:
-        try:
-            parsed = urlparse(raw)
-            server = parsed.hostname or ""
-            port = parsed.port or 443
-            remarks = unquote(parsed.fragment) if parsed.fragment else ""
-            return server, port, remarks
-        except:
-            return "", 0, ""
+        return self._parse_uri(raw)
     
     def _parse_ssr(self, raw: str) -> Tuple[str, int, str]:
         try:
-            encoded = raw.replace("ssr://", "")
-            padding = 4 - len(encoded) % 4
-            if padding != 4:
-                encoded += "=" * padding
-            decoded = base64.urlsafe_b64decode(encoded).decode('utf-8')
+            encoded = raw.encode('ascii', 'ignore').removeprefix(b"ssr://")
+            decoded = urlsafe_b64decode(_pad_b64(encoded)).decode('utf-8')
             parts = decoded.split(":")
             if len(parts) >= 2:
                 server = parts[0]
@@ -113,39 +186,88 @@ class ConfigChecker:
             pass
         return "", 0, ""
     
+    async def _resolve(self, host: str) -> str:
+        """IP адрес хоста с кэшированием; при ошибке возвращается исходное имя"""
+        try:
+            ipaddress.ip_address(host)
+            return host
+        except ValueError:
+            pass
+        
+        now = time.monotonic()
+        cached = self._dns_cache.get(host)
+        if cached and cached[1] > now:
+            return cached[0]
+        
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except (OSError, UnicodeError) as e:
+            logger.debug(f"DNS resolution failed for {host}: {e}")
+            return host
+        
+        ip = infos[0][4][0]
+        _prune_cache(self._dns_cache, lambda value: value[1] > now)
+        self._dns_cache[host] = (ip, now + _DNS_TTL)
+        return ip
+    
     async def check_connectivity(self, host: str, port: int) -> Tuple[bool, float]:
-        """Комплексная проверка доступности сервера"""
+        """Комплексная проверка доступности сервера (результат кэшируется на _PORT_CACHE_TTL)"""
+        key = (host, port)
+        cached = self._connectivity_cache.get(key)
+        if cached and time.monotonic() - cached[1] < _PORT_CACHE_TTL:
+            return cached[0]
+        
+        result = await self._check_connectivity(host, port)
+        now = time.monotonic()
+        _prune_cache(self._connectivity_cache, lambda value: now - value[1] < _PORT_CACHE_TTL)
+        self._connectivity_cache[key] = (result, now)
+        return result
+    
+    async def _check_connectivity(self, host: str, port: int) -> Tuple[bool, float]:
+        # Имя разрешается один раз (через DNS кэш) для TCP и TLS проверок
+        ip = await self._resolve(host)
         try:
-            # Метод 1: TCP соединение (самый надежный)
-            start_time = time.time()
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)  # 5 секунд таймаут
-            result = sock.connect_ex((host, port))
-            end_time = time.time()
-            sock.close()
+            # Метод 1: TCP соединение (самый надежный), не блокирует event loop
+            loop = asyncio.get_running_loop()
+            start_time = loop.time()
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=5)
+            tcp_time = (loop.time() - start_time) * 1000  # в миллисекундах
+            writer.close()
+            await writer.wait_closed()
             
-            if result == 0:
-                tcp_time = (end_time - start_time) * 1000  # в миллисекундах
-                logger.debug(f"TCP connection successful to {host}:{port} in {tcp_time:.2f}ms")
-                return True, tcp_time
-            else:
-                logger.debug(f"TCP connection failed to {host}:{port}")
+            logger.debug(f"TCP connection successful to {host}:{port} in {tcp_time:.2f}ms")
+            return True, tcp_time
                 
         except Exception as e:
             logger.debug(f"TCP check failed for {host}:{port}: {e}")
         
-        # Метод 2: HTTP/HTTPS проверка (если порт 80/443)
-        if port in [80, 443, 8080, 8443]:
+        # Метод 2: TLS рукопожатие для 443/8443 - HTTP ответ не нужен, и не все VPN фронты его отдают
+        if port in [443, 8443]:
             try:
-                import httpx
-                protocol = "https" if port in [443, 8443] else "http"
-                url = f"{protocol}://{host}:{port}"
+                loop = asyncio.get_running_loop()
+                start_time = loop.time()
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(ip, port, ssl=self._probe_ssl_context, server_hostname=host),
+                    timeout=5
+                )
+                tls_time = (loop.time() - start_time) * 1000
+                writer.close()
+                
+                logger.debug(f"TLS handshake successful to {host}:{port} in {tls_time:.2f}ms")
+                return True, tls_time
+                
+            except Exception as e:
+                logger.debug(f"TLS check failed for {host}:{port}: {e}")
+        
+        # Метод 3: HTTP проверка (если порт 80/8080)
+        elif port in [80, 8080]:
+            try:
+                url = f"http://{host}:{port}"
                 
                 start_time = time.time()
-                async with httpx.AsyncClient(timeout=5, verify=False) as client:
-                    response = await client.head(url)
-                    end_time = time.time()
-                    
+                response = await self._get_client().head(url, timeout=5, follow_redirects=False)
+                end_time = time.time()
+                
                 if response.status_code < 500:
                     http_time = (end_time - start_time) * 1000
                     logger.debug(f"HTTP check successful to {url} in {http_time:.2f}ms")
@@ -156,121 +278,250 @@ class ConfigChecker:
         
         return False, 999.0
     
-    async def check_ping(self, host: str) -> Tuple[float, float, float]:
-        """Улучшенная проверка пинга с fallback на connectivity"""
+    async def _tcp_rtt(self, host: str, port: int) -> Optional[float]:
+        """Время установки одного TCP соединения в миллисекундах"""
+        start_time = time.perf_counter()
         try:
-            # Сначала пробуем ICMP ping
-            process = await asyncio.create_subprocess_exec(
-                "ping", "-c", "2", "-W", "2", host,  # Уменьшили количество и таймаут
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, _ = await asyncio.wait_for(process.communicate(), timeout=5)
-            output = stdout.decode()
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=self.timeout)
+        except ConnectionRefusedError:
+            # RST от хоста — это тоже ответ, время до него и есть RTT
+            return (time.perf_counter() - start_time) * 1000
+        except (OSError, asyncio.TimeoutError):
+            return None
+        
+        rtt = (time.perf_counter() - start_time) * 1000
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        return rtt
+    
+    async def _icmp_ping(self, ip: str, count: int) -> Optional[Tuple[float, float, float]]:
+        """ICMP ping через icmplib (без запуска системного ping); None если ICMP недоступен"""
+        if not self._icmp_available:
+            return None
+        try:
+            result = await async_ping(ip, count=count, interval=0.2, timeout=2, privileged=False)
+        except SocketPermissionError as e:
+            logger.info(f"Unprivileged ICMP is not permitted, using TCP probes: {e}")
+            self._icmp_available = False
+            return None
+        except ICMPLibError as e:
+            logger.debug(f"ICMP ping failed for {ip}: {e}")
+            return None
+        
+        if not result.packets_received:
+            # ICMP часто режется фаерволом - проверяем через TCP
+            return None
+        return result.avg_rtt, result.jitter, result.packet_loss * 100
+    
+    async def check_ping(self, host: str, port: int = 443, count: int = 3) -> Tuple[float, float, float]:
+        """Проверка задержки через ICMP (icmplib) или TCP соединения"""
+        try:
+            # Имя разрешается один раз на все попытки
+            ip = await self._resolve(host)
+            icmp_result = await self._icmp_ping(ip, count)
+            if icmp_result:
+                logger.debug(f"ICMP ping to {host}: {icmp_result[0]:.2f}ms, loss: {icmp_result[2]}%")
+                return icmp_result
             
-            times = re.findall(r'time[=<](\d+\.?\d*)', output)
-            if times:
-                pings = [float(t) for t in times]
-                avg_ping = sum(pings) / len(pings)
-                jitter = max(pings) - min(pings) if len(pings) > 1 else 0
+            samples = await asyncio.gather(*[self._tcp_rtt(ip, port) for _ in range(count)])
+            # Сумма, минимум и максимум за один проход без промежуточного списка
+            received = 0
+            total = 0.0
+            low = high = None
+            for rtt in samples:
+                if rtt is None:
+                    continue
+                received += 1
+                total += rtt
+                if low is None or rtt < low:
+                    low = rtt
+                if high is None or rtt > high:
+                    high = rtt
+            if received:
+                avg_ping = total / received
+                jitter = high - low if received > 1 else 0
+                loss = (count - received) / count * 100
                 
-                loss_match = re.search(r'(\d+)% packet loss', output)
-                loss = float(loss_match.group(1)) if loss_match else 0
-                
-                logger.debug(f"ICMP ping to {host}: {avg_ping:.2f}ms, loss: {loss}%")
+                logger.debug(f"TCP ping to {host}:{port}: {avg_ping:.2f}ms, loss: {loss}%")
                 return avg_ping, jitter, loss
                 
         except Exception as e:
-            logger.debug(f"ICMP ping failed for {host}: {e}")
+            logger.debug(f"TCP ping failed for {host}:{port}: {e}")
         
-        # Fallback: если ICMP не работает, возвращаем высокие значения
-        # Но проверка connectivity будет в основном методе
+        # Хост не ответил ни на одну попытку
         return 999.0, 0.0, 100.0
     
-    def check_port(self, host: str, port: int) -> bool:
+    async def check_port(self, host: str, port: int) -> bool:
         """Проверка доступности порта"""
+        key = (host, port)
+        cached = self._port_cache.get(key)
+        if cached and time.monotonic() - cached[1] < _PORT_CACHE_TTL:
+            return cached[0]
+        
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(self.timeout)
-            result = sock.connect_ex((host, port))
-            sock.close()
-            return result == 0
-        except:
-            return False
+            ip = await self._resolve(host)
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=self.timeout)
+            writer.close()
+            is_open = True
+        except (OSError, asyncio.TimeoutError):
+            is_open = False
+        
+        now = time.monotonic()
+        _prune_cache(self._port_cache, lambda value: now - value[1] < _PORT_CACHE_TTL)
+        self._port_cache[key] = (is_open, now)
+        return is_open
     
-    async def fetch_subscription(self, url: str) -> List[str]:
-        """Получение конфигураций из URL подписки"""
-        configs = []
+    def _get_client(self) -> httpx.AsyncClient:
+        """HTTP клиент для текущего event loop (обновление идет и из API, и из фоновой задачи)"""
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            # Клиент живет, пока жив его loop: API и фоновая задача не пересоздают клиенты друг друга
+            client = self._clients[loop] = httpx.AsyncClient(
+                timeout=30,
+                follow_redirects=True,
+                verify=False,  # Отключаем проверку SSL для проблемных сертификатов
+                http2=_HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=40, keepalive_expiry=30)
+            )
+        return client
+    
+    async def aclose(self):
+        """Закрытие HTTP клиента текущего event loop"""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+    
+    async def _iter_configs(self, response: httpx.Response, url: str):
+        """Потоковый разбор тела подписки: конфиги отдаются пачками по мере загрузки, без чтения всего тела"""
+        head = b""
+        is_base64 = None
+        b64_tail = b""  # хвост base64, не кратный 4 символам
+        line_tail = ""  # незавершенная последняя строка
+        text_decoder = None
+        
+        def feed(data: bytes, final: bool = False) -> List[str]:
+            nonlocal b64_tail, line_tail
+            if is_base64:
+                data = b64_tail + b"".join(data.split())
+                if final:
+                    data, b64_tail = _pad_b64(data), b""
+                else:
+                    aligned = len(data) & ~3
+                    data, b64_tail = data[:aligned], data[aligned:]
+                data = b64decode(data)
+            
+            text = line_tail + text_decoder.decode(data, final)
+            if final:
+                line_tail = ""
+            else:
+                cut = text.rfind("\n") + 1
+                text, line_tail = text[:cut], text[cut:]
+            # Выбираем строки с конфигами одним проходом регулярного выражения
+            return _CONFIG_LINE_RE.findall(text)
+        
+        def detect_format():
+            nonlocal is_base64, text_decoder
+            sniff = head[:_SNIFF_SIZE]
+            if _PROTO_SEARCH_RE.search(sniff):
+                # Это готовые конфиги, используем как есть
+                is_base64 = False
+                logger.info(f"Detected direct configs from {url}")
+            else:
+                # Символы вне алфавита base64 - декодировать нечего
+                is_base64 = bool(sniff) and _BASE64_PREFIX_RE.fullmatch(sniff) is not None
+            
+            if is_base64:
+                text_decoder = codecs.getincrementaldecoder('utf-8')()
+            else:
+                encoding = response.charset_encoding or 'utf-8'
+                try:
+                    text_decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+                except LookupError:
+                    text_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        
         try:
-            # Улучшенные заголовки для GitHub и других сервисов
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "Accept": "text/plain, application/octet-stream, */*",
-                "Accept-Encoding": "gzip, deflate",
-                "Cache-Control": "no-cache",
-                "Pragma": "no-cache"
-            }
+            async for chunk in response.aiter_bytes(_STREAM_CHUNK_SIZE):
+                if is_base64 is None:
+                    head += chunk
+                    if len(head) < _SNIFF_SIZE:
+                        continue
+                    detect_format()
+                    chunk, head = head, b""
+                yield feed(chunk)
             
-            # Настройки клиента с поддержкой SSL
-            async with httpx.AsyncClient(
-                timeout=30, 
-                follow_redirects=True,
-                verify=False  # Отключаем проверку SSL для проблемных сертификатов
-            ) as client:
-                response = await client.get(url, headers=headers)
-                
+            if is_base64 is None:
+                detect_format()
+                yield feed(head, final=True)
+            else:
+                yield feed(b"", final=True)
+        except (binascii.Error, ValueError) as e:
+            # Одна попытка декодирования: повтор на тех же данных ничего не меняет
+            logger.debug(f"Base64 decode failed for {url}: {e}")
+            return
+        
+        if is_base64:
+            logger.info(f"Successfully decoded base64 from {url}")
+    
+    async def _stream_subscription(self, url: str):
+        """Конфиги из URL подписки пачками по мере загрузки"""
+        try:
+            client = self._get_client()
+            async with client.stream("GET", url, headers=_SUBSCRIPTION_HEADERS) as response:
                 if response.status_code == 200:
-                    content = response.text
-                    
-                    # Проверяем если контент уже содержит готовые конфиги
-                    if any(proto in content for proto in ['vless://', 'vmess://', 'trojan://', 'ss://', 'ssr://']):
-                        # Это готовые конфиги, используем как есть
-                        final_content = content
-                        logger.info(f"Detected direct configs from {url}")
-                    else:
-                        # Попробуем декодировать base64
-                        decoded_content = content
-                        for attempt in range(3):
-                            try:
-                                # Убираем возможные пробелы и переносы
-                                clean_content = content.strip().replace('\n', '').replace('\r', '')
-                                # Добавляем padding если нужно
-                                padding_needed = len(clean_content) % 4
-                                if padding_needed:
-                                    clean_content += '=' * (4 - padding_needed)
-                                
-                                decoded = base64.b64decode(clean_content).decode('utf-8')
-                                decoded_content = decoded
-                                logger.info(f"Successfully decoded base64 from {url}")
-                                break
-                            except Exception as e:
-                                if attempt == 2:  # Последняя попытка
-                                    logger.debug(f"Base64 decode failed after 3 attempts: {e}")
-                                continue
-                        
-                        # Используем декодированный контент или оригинал
-                        final_content = decoded_content if decoded_content != content else content
-                    
-                    # Разбиваем на строки и фильтруем
-                    for line in final_content.split('\n'):
-                        line = line.strip()
-                        if line and any(line.startswith(p) for p in ['vless://', 'vmess://', 'trojan://', 'ss://', 'ssr://']):
-                            configs.append(line)
-                    
-                    logger.info(f"Fetched {len(configs)} configs from {url}")
-                    
+                    async for batch in self._iter_configs(response, url):
+                        yield batch
                 else:
                     logger.error(f"HTTP {response.status_code} for {url}")
-                    
+                
         except httpx.SSLError as e:
             logger.error(f"SSL error for {url}: {e}")
         except httpx.TimeoutException as e:
             logger.error(f"Timeout for {url}: {e}")
         except Exception as e:
             logger.error(f"Failed to fetch subscription {url}: {e}")
-        
+    
+    async def fetch_subscription(self, url: str) -> List[str]:
+        """Получение конфигураций из URL подписки"""
+        configs = [config async for batch in self._stream_subscription(url) for config in batch]
+        logger.info(f"Fetched {len(configs)} configs from {url}")
         return configs
     
+    async def fetch_and_process(self, url: str, concurrency: int = 128) -> Tuple[int, List[Optional[dict]]]:
+        """Загрузка подписки с обработкой конфигов по мере поступления строк (одинаковые - один раз)"""
+        queue = asyncio.Queue(maxsize=_PIPELINE_QUEUE_SIZE)
+        raws = []
+        by_raw = {}
+        
+        async def worker():
+            while (raw := await queue.get()) is not None:
+                try:
+                    by_raw[raw] = await self.process_config(raw)
+                except Exception as e:
+                    logger.warning(f"Failed to process config {raw[:50]}: {e}")
+        
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            # Заполненная очередь приостанавливает загрузку, пока обработчики не разберут строки
+            async for batch in self._stream_subscription(url):
+                for raw in batch:
+                    raws.append(raw)
+                    if raw not in by_raw:
+                        by_raw[raw] = None
+                        await queue.put(raw)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        
+        logger.info(f"Fetched {len(raws)} configs from {url}")
+        return len(raws), [by_raw[raw] for raw in raws]
+    
     async def process_config(self, raw: str) -> Optional[dict]:
         """Обработка одной конфигурации - БЕЗ проверки пинга"""
         protocol, server, port, remarks = self.parse_config(raw)
@@ -296,6 +547,34 @@ class ConfigChecker:
             "packet_loss": loss,
             "is_active": is_active
         }
+    
+    async def process_batch(self, raws: List[str], concurrency: int = 128) -> list:
+        """Параллельная обработка конфигураций с ограничением одновременных проверок"""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def process_bounded(raw: str) -> Optional[dict]:
+            async with semaphore:
+                return await self.process_config(raw)
+        
+        # Исключения возвращаются на месте результата, чтобы один конфиг не ронял весь пакет
+        return await asyncio.gather(
+            *[process_bounded(raw) for raw in raws],
+            return_exceptions=True
+        )
+    
+    async def process_configs(self, raws: List[str], concurrency: int = 128) -> List[Optional[dict]]:
+        """Пакетная обработка конфигураций - одинаковые строки обрабатываются один раз"""
+        unique_raws = list(dict.fromkeys(raws))
+        results = await self.process_batch(unique_raws, concurrency)
+        
+        by_raw = {}
+        for raw, result in zip(unique_raws, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to process config {raw[:50]}: {result}")
+                result = None
+            by_raw[raw] = result
+        
+        return [by_raw[raw] for raw in raws]
 
 
 checker = ConfigChecker()
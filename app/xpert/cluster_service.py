@@ -1,12 +1,42 @@
 import json
 import logging
-from typing import Dict, List, Optional, Set
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, FrozenSet, List, Optional, Tuple
 from datetime import datetime
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS whitelists (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    is_active INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    whitelist_id TEXT NOT NULL REFERENCES whitelists(id) ON DELETE CASCADE,
+    host TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    country TEXT NOT NULL DEFAULT '',
+    is_active INTEGER NOT NULL DEFAULT 1,
+    added_at TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS ix_hosts_whitelist_host ON hosts (whitelist_id, host);
+"""
+
+# slots: без __dict__ у каждой записи, поля лежат компактно и читаются быстрее при сканировании
+@dataclass(slots=True)
 class AllowedHost:
     """Разрешенный хост (IP или домен)"""
     host: str  # IP или домен
@@ -15,7 +45,7 @@ class AllowedHost:
     is_active: bool = True
     added_at: str = ""
 
-@dataclass 
+@dataclass(slots=True)
 class HostWhitelist:
     """Белый список хостов (IP и домены)"""
     id: str
@@ -31,67 +61,167 @@ class WhitelistService:
     
     def __init__(self):
         self.whitelists: Dict[str, HostWhitelist] = {}
+        # Индекс host -> [(белый список, запись хоста)] для поиска без перебора всех списков
+        self._host_index: Dict[str, List[Tuple[HostWhitelist, AllowedHost]]] = {}
+        self.db_file = "host_whitelist.db"
+        # Прежний JSON файл, переносится в базу при первом запуске
         self.storage_file = "host_whitelist.json"
+        # Номер версии растет при каждом изменении белых списков
+        self.version = 0
+        # Множество активных хостов пересчитывается только при смене версии
+        self._allowed_hosts_cache: Optional[FrozenSet[str]] = None
+        self._allowed_hosts_version = -1
+        # RLock: изменения внутри bulk_update берут блокировку повторно
+        self._db_lock = threading.RLock()
+        self._in_bulk = False
+        self._db = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.executescript(_SCHEMA)
+        self._load_whitelists()
+        self._rebuild_host_index()
+    
+    def _rebuild_host_index(self):
+        """Перестраивает индекс хостов по текущим белым спискам"""
+        index = {}
+        for whitelist in self.whitelists.values():
+            for allowed_host in whitelist.allowed_hosts:
+                index.setdefault(allowed_host.host, []).append((whitelist, allowed_host))
+        self._host_index = index
+    
+    def _unindex(self, whitelist: HostWhitelist, host: str):
+        """Убирает записи хоста одного белого списка из индекса"""
+        entries = [entry for entry in self._host_index.get(host, ()) if entry[0] is not whitelist]
+        if entries:
+            self._host_index[host] = entries
+        else:
+            self._host_index.pop(host, None)
+    
+    @contextmanager
+    def _transaction(self):
+        """Транзакция изменения; внутри bulk_update коммит откладывается до выхода из блока"""
+        with self._db_lock:
+            if self._in_bulk:
+                yield
+            else:
+                with self._db:
+                    yield
+    
+    @contextmanager
+    def bulk_update(self):
+        """Объединяет несколько изменений белых списков в одну транзакцию"""
+        with self._db_lock:
+            self._in_bulk = True
+            try:
+                with self._db:
+                    yield self
+            except Exception:
+                # База откатилась, память приводится к ее состоянию
+                self._reload()
+                raise
+            finally:
+                self._in_bulk = False
+    
+    def _reload(self):
+        """Перечитывает белые списки из базы"""
+        self.whitelists = {}
         self._load_whitelists()
+        self._rebuild_host_index()
+        self._mark_dirty()
+    
+    def _has_host(self, whitelist: HostWhitelist, host: str) -> bool:
+        return any(w is whitelist for w, _ in self._host_index.get(host, ()))
+    
+    def _execute(self, sql: str, params=()):
+        """Выполняет изменение в базе одной транзакцией"""
+        with self._transaction():
+            self._db.execute(sql, params)
     
     def _load_whitelists(self):
-        """Загружает белые списки из файла"""
+        """Загружает белые списки из базы (при первом запуске переносит JSON файл)"""
         try:
-            with open(self.storage_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                for whitelist_id, whitelist_data in data.items():
-                    hosts = [AllowedHost(**host) for host in whitelist_data['allowed_hosts']]
-                    self.whitelists[whitelist_id] = HostWhitelist(
-                        id=whitelist_data['id'],
-                        name=whitelist_data['name'],
-                        description=whitelist_data['description'],
-                        allowed_hosts=hosts,
-                        created_at=whitelist_data['created_at'],
-                        updated_at=whitelist_data['updated_at'],
-                        is_active=whitelist_data.get('is_active', True)
-                    )
-                logger.info(f"Loaded {len(self.whitelists)} host whitelists")
-        except FileNotFoundError:
-            logger.info("No host whitelist file found, starting empty")
+            if not self._db.execute("SELECT 1 FROM whitelists LIMIT 1").fetchone():
+                self._migrate_json()
+            
+            for row in self._db.execute(
+                "SELECT id, name, description, created_at, updated_at, is_active FROM whitelists ORDER BY rowid"
+            ):
+                self.whitelists[row[0]] = HostWhitelist(
+                    id=row[0],
+                    name=row[1],
+                    description=row[2],
+                    allowed_hosts=[],
+                    created_at=row[3],
+                    updated_at=row[4],
+                    is_active=bool(row[5])
+                )
+            for row in self._db.execute(
+                "SELECT whitelist_id, host, description, country, is_active, added_at FROM hosts ORDER BY rowid"
+            ):
+                whitelist = self.whitelists.get(row[0])
+                if whitelist is not None:
+                    whitelist.allowed_hosts.append(AllowedHost(
+                        host=row[1],
+                        description=row[2],
+                        country=row[3],
+                        is_active=bool(row[4]),
+                        added_at=row[5]
+                    ))
+            logger.info(f"Loaded {len(self.whitelists)} host whitelists")
         except Exception as e:
             logger.error(f"Error loading host whitelist: {e}")
     
-    def _save_whitelists(self):
-        """Сохраняет белые списки в файл"""
+    def _migrate_json(self):
+        """Однократный перенос белых списков из JSON файла в базу"""
         try:
-            data = {}
-            for whitelist_id, whitelist in self.whitelists.items():
-                data[whitelist_id] = {
-                    'id': whitelist.id,
-                    'name': whitelist.name,
-                    'description': whitelist.description,
-                    'allowed_hosts': [asdict(host) for host in whitelist.allowed_hosts],
-                    'created_at': whitelist.created_at,
-                    'updated_at': whitelist.updated_at,
-                    'is_active': whitelist.is_active
-                }
-            
-            with open(self.storage_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            logger.info(f"Saved {len(self.whitelists)} host whitelists")
-        except Exception as e:
-            logger.error(f"Error saving host whitelist: {e}")
+            with open(self.storage_file, 'rb') as f:
+                data = _json_loads(f.read())
+        except FileNotFoundError:
+            logger.info("No host whitelist file found, starting empty")
+            return
+        
+        with self._transaction():
+            for whitelist_data in data.values():
+                self._db.execute(
+                    "INSERT INTO whitelists (id, name, description, created_at, updated_at, is_active) VALUES (?, ?, ?, ?, ?, ?)",
+                    (whitelist_data['id'], whitelist_data['name'], whitelist_data['description'],
+                     whitelist_data['created_at'], whitelist_data['updated_at'], whitelist_data.get('is_active', True))
+                )
+                self._db.executemany(
+                    "INSERT INTO hosts (whitelist_id, host, description, country, is_active, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (whitelist_data['id'], host['host'], host.get('description', ""), host.get('country', ""),
+                         host.get('is_active', True), host.get('added_at', ""))
+                        for host in whitelist_data['allowed_hosts']
+                    ]
+                )
+        # Файл сохраняется как резервная копия и больше не читается
+        os.replace(self.storage_file, f"{self.storage_file}.migrated")
+        logger.info(f"Migrated {len(data)} host whitelists from {self.storage_file} to {self.db_file}")
+    
+    def _mark_dirty(self):
+        """Отмечает изменение белых списков: кэш разрешенных хостов будет пересчитан"""
+        self.version += 1
     
     def create_whitelist(self, name: str, description: str = "") -> str:
         """Создает новый белый список хостов"""
         whitelist_id = f"whitelist_{len(self.whitelists) + 1}_{int(datetime.now().timestamp())}"
+        now = datetime.utcnow().isoformat()
         
         whitelist = HostWhitelist(
             id=whitelist_id,
             name=name,
             description=description,
             allowed_hosts=[],
-            created_at=datetime.utcnow().isoformat(),
-            updated_at=datetime.utcnow().isoformat()
+            created_at=now,
+            updated_at=now
         )
         
+        self._execute(
+            "INSERT INTO whitelists (id, name, description, created_at, updated_at, is_active) VALUES (?, ?, ?, ?, ?, ?)",
+            (whitelist_id, name, description, now, now, True)
+        )
         self.whitelists[whitelist_id] = whitelist
-        self._save_whitelists()
+        self._mark_dirty()
         
         logger.info(f"Created host whitelist: {name} ({whitelist_id})")
         return whitelist_id
@@ -102,45 +232,113 @@ class WhitelistService:
             logger.error(f"Host whitelist {whitelist_id} not found")
             return False
         
+        # Хост уже в списке: ничего не меняем и не пишем в базу
+        if self._has_host(self.whitelists[whitelist_id], host):
+            logger.debug(f"Host {host} already in whitelist {whitelist_id}")
+            return True
+        
+        now = datetime.utcnow().isoformat()
         allowed_host = AllowedHost(
             host=host,
             description=description,
             country=country,
-            added_at=datetime.utcnow().isoformat()
+            added_at=now
         )
         
+        with self._transaction():
+            self._db.execute(
+                "INSERT INTO hosts (whitelist_id, host, description, country, is_active, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (whitelist_id, host, description, country, True, now)
+            )
+            self._db.execute("UPDATE whitelists SET updated_at = ? WHERE id = ?", (now, whitelist_id))
+        
         self.whitelists[whitelist_id].allowed_hosts.append(allowed_host)
-        self.whitelists[whitelist_id].updated_at = datetime.utcnow().isoformat()
-        self._save_whitelists()
+        self._host_index.setdefault(host, []).append((self.whitelists[whitelist_id], allowed_host))
+        self.whitelists[whitelist_id].updated_at = now
+        self._mark_dirty()
         
         logger.info(f"Added allowed host {host} to whitelist {whitelist_id}")
         return True
     
-    def get_all_allowed_hosts(self) -> Set[str]:
-        """Получает все разрешенные хосты (IP и домены)"""
-        allowed_hosts = set()
+    def add_allowed_hosts(self, whitelist_id: str, entries: List[Dict]) -> int:
+        """Добавляет несколько хостов одним вызовом: одна метка времени и одна транзакция"""
+        if whitelist_id not in self.whitelists:
+            logger.error(f"Host whitelist {whitelist_id} not found")
+            return 0
         
-        for whitelist in self.whitelists.values():
-            if not whitelist.is_active:
+        whitelist = self.whitelists[whitelist_id]
+        now = datetime.utcnow().isoformat()
+        # Хосты, уже присутствующие в списке или повторяющиеся в пакете, пропускаются
+        seen = set()
+        new_hosts = []
+        for entry in entries:
+            host = entry['host']
+            if host in seen or self._has_host(whitelist, host):
                 continue
-                
-            for host in whitelist.allowed_hosts:
-                if host.is_active:
-                    allowed_hosts.add(host.host)
+            seen.add(host)
+            new_hosts.append(AllowedHost(
+                host=host,
+                description=entry.get('description', ""),
+                country=entry.get('country', ""),
+                added_at=now
+            ))
+        if not new_hosts:
+            return 0
+        
+        with self._transaction():
+            self._db.executemany(
+                "INSERT INTO hosts (whitelist_id, host, description, country, is_active, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(whitelist_id, h.host, h.description, h.country, True, now) for h in new_hosts]
+            )
+            self._db.execute("UPDATE whitelists SET updated_at = ? WHERE id = ?", (now, whitelist_id))
+        
+        for allowed_host in new_hosts:
+            whitelist.allowed_hosts.append(allowed_host)
+            self._host_index.setdefault(allowed_host.host, []).append((whitelist, allowed_host))
+        whitelist.updated_at = now
+        self._mark_dirty()
+        
+        logger.info(f"Added {len(new_hosts)} allowed hosts to whitelist {whitelist_id}")
+        return len(new_hosts)
+    
+    def get_all_allowed_addresses(self) -> FrozenSet[str]:
+        """Получает все разрешенные адреса: IP, домены и CIDR-диапазоны одним множеством"""
+        allowed_hosts = self._allowed_hosts_cache
+        if allowed_hosts is None or self._allowed_hosts_version != self.version:
+            version = self.version
+            allowed_hosts = frozenset(
+                host.host
+                for whitelist in self.whitelists.values() if whitelist.is_active
+                for host in whitelist.allowed_hosts if host.is_active
+            )
+            self._allowed_hosts_cache = allowed_hosts
+            self._allowed_hosts_version = version
+            logger.info(f"Found {len(allowed_hosts)} allowed hosts")
         
-        logger.info(f"Found {len(allowed_hosts)} allowed hosts")
         return allowed_hosts
     
     def update_host_status(self, host: str, is_active: bool):
         """Обновляет статус хоста"""
-        for whitelist in self.whitelists.values():
-            for allowed_host in whitelist.allowed_hosts:
-                if allowed_host.host == host:
-                    allowed_host.is_active = is_active
-                    whitelist.updated_at = datetime.utcnow().isoformat()
-                    self._save_whitelists()
-                    logger.info(f"Updated host {host}: active={is_active}")
-                    return True
+        entries = self._host_index.get(host)
+        if entries:
+            whitelist = entries[0][0]
+            # Старые JSON могут содержать хост в списке несколько раз: UPDATE меняет все копии
+            allowed_hosts = [allowed_host for w, allowed_host in entries if w is whitelist]
+            if all(allowed_host.is_active == is_active for allowed_host in allowed_hosts):
+                return True
+            now = datetime.utcnow().isoformat()
+            with self._transaction():
+                self._db.execute(
+                    "UPDATE hosts SET is_active = ? WHERE whitelist_id = ? AND host = ?",
+                    (is_active, whitelist.id, host)
+                )
+                self._db.execute("UPDATE whitelists SET updated_at = ? WHERE id = ?", (now, whitelist.id))
+            for allowed_host in allowed_hosts:
+                allowed_host.is_active = is_active
+            whitelist.updated_at = now
+            self._mark_dirty()
+            logger.info(f"Updated host {host}: active={is_active}")
+            return True
         
         logger.warning(f"Host {host} not found in any whitelist")
         return False
@@ -151,8 +349,12 @@ class WhitelistService:
             logger.error(f"Host whitelist {whitelist_id} not found")
             return False
         
-        del self.whitelists[whitelist_id]
-        self._save_whitelists()
+        # Хосты списка удаляются каскадно
+        self._execute("DELETE FROM whitelists WHERE id = ?", (whitelist_id,))
+        whitelist = self.whitelists.pop(whitelist_id)
+        for allowed_host in whitelist.allowed_hosts:
+            self._unindex(whitelist, allowed_host.host)
+        self._mark_dirty()
         
         logger.info(f"Deleted host whitelist {whitelist_id}")
         return True
@@ -164,30 +366,61 @@ class WhitelistService:
             return False
         
         whitelist = self.whitelists[whitelist_id]
-        original_count = len(whitelist.allowed_hosts)
+        # Наличие хоста проверяется по индексу, без перебора списка
+        if not self._has_host(whitelist, host):
+            logger.warning(f"Host {host} not found in whitelist {whitelist_id}")
+            return False
         
+        now = datetime.utcnow().isoformat()
+        with self._transaction():
+            self._db.execute("DELETE FROM hosts WHERE whitelist_id = ? AND host = ?", (whitelist_id, host))
+            self._db.execute("UPDATE whitelists SET updated_at = ? WHERE id = ?", (now, whitelist_id))
         whitelist.allowed_hosts = [
             h for h in whitelist.allowed_hosts if h.host != host
         ]
+        self._unindex(whitelist, host)
+        whitelist.updated_at = now
+        self._mark_dirty()
+        logger.info(f"Removed host {host} from whitelist {whitelist_id}")
+        return True
+    
+    def remove_host(self, host: str) -> int:
+        """Удаляет хост из всех белых списков; возвращает число затронутых списков"""
+        entries = self._host_index.pop(host, None)
+        if not entries:
+            logger.warning(f"Host {host} not found in any whitelist")
+            return 0
         
-        if len(whitelist.allowed_hosts) < original_count:
-            whitelist.updated_at = datetime.utcnow().isoformat()
-            self._save_whitelists()
-            logger.info(f"Removed host {host} from whitelist {whitelist_id}")
-            return True
-        else:
-            logger.warning(f"Host {host} not found in whitelist {whitelist_id}")
-            return False
+        whitelists = list({id(w): w for w, _ in entries}.values())
+        now = datetime.utcnow().isoformat()
+        with self._transaction():
+            self._db.execute("DELETE FROM hosts WHERE host = ?", (host,))
+            self._db.executemany(
+                "UPDATE whitelists SET updated_at = ? WHERE id = ?",
+                [(now, w.id) for w in whitelists]
+            )
+        for whitelist in whitelists:
+            whitelist.allowed_hosts = [h for h in whitelist.allowed_hosts if h.host != host]
+            whitelist.updated_at = now
+        self._mark_dirty()
+        
+        logger.info(f"Removed host {host} from {len(whitelists)} whitelists")
+        return len(whitelists)
     
     def get_whitelist_stats(self) -> Dict:
         """Получает статистику по белым спискам"""
         total_whitelists = len(self.whitelists)
-        active_whitelists = sum(1 for w in self.whitelists.values() if w.is_active)
-        total_hosts = sum(len(w.allowed_hosts) for w in self.whitelists.values())
-        active_hosts = sum(
-            sum(1 for h in w.allowed_hosts if h.is_active)
-            for w in self.whitelists.values()
-        )
+        active_whitelists = 0
+        total_hosts = 0
+        active_hosts = 0
+        # Один проход по спискам и хостам вместо четырех
+        for w in self.whitelists.values():
+            if w.is_active:
+                active_whitelists += 1
+            total_hosts += len(w.allowed_hosts)
+            for h in w.allowed_hosts:
+                if h.is_active:
+                    active_hosts += 1
         
         return {
             "total_whitelists": total_whitelists,
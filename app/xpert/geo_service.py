@@ -1,15 +1,48 @@
-import re
+import atexit
+import json
+import os
 import socket
-from typing import Optional, Dict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Tuple
 import requests
 import logging
 
+from app.xpert.storage import storage
+from config import XPERT_GEOIP_DB
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
 logger = logging.getLogger(__name__)
 
+# Время жизни записей кэша геолокации (секунды)
+GEO_CACHE_TTL = 86400
+# Сколько новых записей накапливается до промежуточной записи кэша на диск
+_GEO_CACHE_FLUSH_EVERY = 100
+# Пакетный запрос ip-api.com принимает до 100 IP
+GEO_BATCH_URL = "http://ip-api.com/batch?fields=status,country,countryCode"
+GEO_BATCH_SIZE = 100
+# Потоки для параллельного разрешения доменов
+GEO_DNS_WORKERS = 32
+
 class GeoService:
     def __init__(self):
         # Кэш для результатов геолокации
         self._cache: Dict[str, Dict[str, str]] = {}
+        # Время получения каждой записи кэша
+        self._cache_ts: Dict[str, float] = {}
+        self._cache_file = os.path.join(storage.data_dir, "geo_cache.json")
+        self._unsaved = 0
+        # Одна HTTP сессия: соединение с ip-api.com переиспользуется между запросами
+        self._session = requests.Session()
+        # Общий пул для DNS запросов, создается один раз
+        self._dns_executor = ThreadPoolExecutor(max_workers=GEO_DNS_WORKERS, thread_name_prefix="geo-dns")
+        self._load_cache()
+        atexit.register(self.save_cache)
+        self._reader = self._open_geoip_db()
         
         # Флаги стран (emoji) - расширенный список
         self.country_flags = {
@@ -32,8 +65,8 @@ class GeoService:
             'TM': '🇹🇲', 'AF': '🇦🇫', 'PK': '🇵🇰', 'BD': '🇧🇩', 'LK': '🇱🇰',
             'NP': '🇳🇵', 'BT': '🇧🇹', 'MV': '🇲🇻', 'MM': '🇲🇲', 'LA': '🇱🇦',
             'KH': '🇰🇭', 'BN': '🇧🇳', 'DO': '🇩🇴', 'CR': '🇨🇷', 'GT': '🇬🇹',
-            'PA': '🇵🇦', 'EC': '🇪🇨', 'BO': '🇧🇴', 'PY': '�🇾', 'UY': '🇺🇾',
-            'NI': '🇳🇮', 'SV': '🇸🇻', 'HN': '�🇭🇳', 'JM': '🇯🇲', 'TT': '🇹🇹',
+            'PA': '🇵🇦', 'EC': '🇪🇨', 'BO': '🇧🇴', 'PY': '🇵🇾', 'UY': '🇺🇾',
+            'NI': '🇳🇮', 'SV': '🇸🇻', 'HN': '🇭🇳', 'JM': '🇯🇲', 'TT': '🇹🇹',
             'BB': '🇧🇧', 'GD': '🇬🇩', 'LC': '🇱🇨', 'VC': '🇻🇨', 'AG': '🇦🇬',
             'DM': '🇩🇲', 'KN': '🇰🇳', 'BS': '🇧🇸', 'BM': '🇧🇲', 'KY': '🇰🇾',
             'FK': '🇫🇰', 'GI': '🇬🇮', 'IM': '🇮🇲', 'JE': '🇯🇪', 'GG': '🇬🇬',
@@ -41,7 +74,7 @@ class GeoService:
             'PM': '🇵🇲', 'WF': '🇼🇫', 'PF': '🇵🇫', 'NU': '🇳🇺', 'CK': '🇨🇰',
             'AS': '🇦🇸', 'GU': '🇬🇺', 'MP': '🇲🇵', 'VI': '🇻🇮', 'PR': '🇵🇷',
             'UM': '🇺🇲', 'PW': '🇵🇼', 'FM': '🇫🇲', 'MH': '🇲🇭', 'KI': '🇰🇮',
-            'NR': '🇳🇷', 'TV': '🇹🇻', 'TO': '🇹🇴', 'WS': '🇼🇸', 'SB': '��🇧',
+            'NR': '🇳🇷', 'TV': '🇹🇻', 'TO': '🇹🇴', 'WS': '🇼🇸', 'SB': '🇸🇧',
             'VU': '🇻🇺', 'FJ': '🇫🇯', 'NC': '🇳🇨', 'PF': '🇵🇫', 'AS': '🇦🇸',
             'CK': '🇨🇰', 'NU': '🇳🇺', 'TK': '🇹🇰', 'PN': '🇵🇳', 'WF': '🇼🇫'
         }
@@ -78,7 +111,94 @@ class GeoService:
             'LI': 'Liechtenstein', 'LU': 'Luxembourg', 'NO': 'Norway', 'PT': 'Portugal',
             'SE': 'Sweden', 'ES': 'Spain', 'IT': 'Italy', 'MT': 'Malta'
         }
+        
+        # Флаг и название по коду страны одним обращением к словарю
+        self.country_data: Dict[str, Tuple[str, str]] = {
+            code: (self.country_flags.get(code, '🌍'), self.country_names.get(code, 'Unknown'))
+            for code in self.country_flags.keys() | self.country_names.keys()
+        }
 
+    def _open_geoip_db(self):
+        """Открывает локальную базу MaxMind, если она настроена"""
+        if not XPERT_GEOIP_DB:
+            return None
+        if maxminddb is None:
+            logger.warning("XPERT_GEOIP_DB is set but maxminddb is not installed, using ip-api.com")
+            return None
+        try:
+            reader = maxminddb.open_database(XPERT_GEOIP_DB, maxminddb.MODE_MMAP)
+            logger.info(f"Using local GeoIP database {XPERT_GEOIP_DB}")
+            return reader
+        except Exception as e:
+            logger.warning(f"Failed to open GeoIP database {XPERT_GEOIP_DB}: {e}")
+            return None
+    
+    def _lookup_local(self, ip: str) -> Optional[Dict[str, str]]:
+        """Страна по локальной базе MaxMind (None, если базы нет или IP не найден)"""
+        if self._reader is None:
+            return None
+        try:
+            record = self._reader.get(ip)
+        except ValueError:
+            return None
+        country = record and (record.get('country') or record.get('registered_country'))
+        if not country or 'iso_code' not in country:
+            return None
+        country_code = country['iso_code']
+        flag, known_name = self.country_data.get(country_code, ('🌍', 'Unknown'))
+        country_name = country.get('names', {}).get('en', known_name)
+        return {
+            'country': country_name,
+            'code': country_code,
+            'flag': flag,
+            'name': country_name
+        }
+    
+    def _load_cache(self):
+        """Загрузка кэша геолокации с диска (без просроченных записей)"""
+        try:
+            with open(self._cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Failed to load geo cache: {e}")
+            return
+        
+        now = time.time()
+        for server, entry in data.items():
+            if now - entry.get('ts', 0) < GEO_CACHE_TTL:
+                self._cache[server] = entry['result']
+                self._cache_ts[server] = entry['ts']
+        logger.info(f"Loaded {len(self._cache)} geo cache entries")
+    
+    def save_cache(self):
+        """Сохранение успешно определенных стран на диск"""
+        if not self._unsaved:
+            return
+        try:
+            data = {
+                server: {'result': result, 'ts': self._cache_ts[server]}
+                for server, result in list(self._cache.items())
+                if result['code'] != 'UN' and server in self._cache_ts
+            }
+            tmp_file = f"{self._cache_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_file, self._cache_file)
+            self._unsaved = 0
+        except Exception as e:
+            logger.warning(f"Failed to save geo cache: {e}")
+    
+    def _remember(self, server: str, result: Dict[str, str]):
+        """Кэширует результат; удачные определения периодически сбрасываются на диск"""
+        self._cache[server] = result
+        self._cache_ts[server] = time.time()
+        if result['code'] != 'UN':
+            self._unsaved += 1
+            if self._unsaved >= _GEO_CACHE_FLUSH_EVERY:
+                self.save_cache()
+    
     def get_server_ip(self, server: str) -> Optional[str]:
         """Получить IP адрес сервера по доменному имени"""
         try:
@@ -86,40 +206,37 @@ class GeoService:
         except:
             return None
 
+    def resolve_all(self, servers: List[str]) -> Dict[str, Optional[str]]:
+        """Параллельно получить IP адреса списка серверов (None для неразрешенных)"""
+        servers = list(dict.fromkeys(servers))
+        return dict(zip(servers, self._dns_executor.map(self.get_server_ip, servers)))
+
     def get_country_info(self, server: str) -> Dict[str, str]:
         """Получить информацию о стране сервера"""
         # Проверяем кэш
-        if server in self._cache:
-            return self._cache[server]
+        cached = self._cache.get(server)
+        if cached is not None and time.time() - self._cache_ts.get(server, 0) < GEO_CACHE_TTL:
+            return cached
         
         # Получаем IP
         ip = self.get_server_ip(server)
         if not ip:
             return {'country': 'Unknown', 'code': 'UN', 'flag': '🌍', 'name': 'Unknown'}
         
+        result = self._lookup_local(ip)
+        if result:
+            self._remember(server, result)
+            return result
+        
         try:
             # Используем бесплатный API для геолокации
-            response = requests.get(f"http://ip-api.com/json/{ip}?fields=status,country,countryCode", timeout=3)
+            response = self._session.get(f"http://ip-api.com/json/{ip}?fields=status,country,countryCode", timeout=3)
             
             if response.status_code == 200:
-                data = response.json()
-                
-                if data.get('status') == 'success':
-                    country_code = data.get('countryCode', 'UN')
-                    country_name = data.get('country', 'Unknown')
-                    
-                    # Получаем флаг
-                    flag = self.country_flags.get(country_code, '🌍')
-                    
-                    result = {
-                        'country': country_name,
-                        'code': country_code,
-                        'flag': flag,
-                        'name': country_name
-                    }
-                    
+                result = self._make_result(response.json())
+                if result:
                     # Кэшируем результат
-                    self._cache[server] = result
+                    self._remember(server, result)
                     return result
         
         except Exception as e:
@@ -127,9 +244,86 @@ class GeoService:
         
         # Если не удалось определить, возвращаем значение по умолчанию
         result = {'country': 'Unknown', 'code': 'UN', 'flag': '🌍', 'name': 'Unknown'}
-        self._cache[server] = result
+        self._remember(server, result)
         return result
 
+    def _prepare_batch(self, servers: List[str]) -> Tuple[Dict[str, Dict[str, str]], Dict[str, List[str]]]:
+        """Отделяет закэшированные сервера и группирует остальные по IP"""
+        results = {}
+        pending: Dict[str, List[str]] = {}
+        uncached = []
+        now = time.time()
+        
+        for server in dict.fromkeys(servers):
+            cached = self._cache.get(server)
+            if cached is not None and now - self._cache_ts.get(server, 0) < GEO_CACHE_TTL:
+                results[server] = cached
+            else:
+                uncached.append(server)
+        
+        for server, ip in self.resolve_all(uncached).items():
+            if not ip:
+                results[server] = {'country': 'Unknown', 'code': 'UN', 'flag': '🌍', 'name': 'Unknown'}
+                continue
+            result = self._lookup_local(ip)
+            if result:
+                self._remember(server, result)
+                results[server] = result
+                continue
+            pending.setdefault(ip, []).append(server)
+        
+        return results, pending
+
+    def _store_batch(self, results: Dict, pending: Dict[str, List[str]], chunk: List[str], answers: List[Dict]):
+        """Кэширует ответ пакетного запроса; ответ ip-api сохраняет порядок запросов"""
+        for ip, data in zip(chunk, answers):
+            result = self._make_result(data)
+            if result:
+                for server in pending.pop(ip):
+                    self._remember(server, result)
+                    results[server] = result
+
+    def _finish_batch(self, results: Dict, pending: Dict[str, List[str]]) -> Dict[str, Dict[str, str]]:
+        """Не определенные пакетом сервера помечаются как Unknown"""
+        for servers_left in pending.values():
+            for server in servers_left:
+                result = {'country': 'Unknown', 'code': 'UN', 'flag': '🌍', 'name': 'Unknown'}
+                self._remember(server, result)
+                results[server] = result
+        return results
+
+    def get_country_info_batch(self, servers: List[str]) -> Dict[str, Dict[str, str]]:
+        """Получить информацию о странах для списка серверов пакетными запросами"""
+        results, pending = self._prepare_batch(servers)
+        
+        ips = list(pending)
+        for i in range(0, len(ips), GEO_BATCH_SIZE):
+            chunk = ips[i:i + GEO_BATCH_SIZE]
+            answers = []
+            try:
+                response = self._session.post(GEO_BATCH_URL, json=[{"query": ip} for ip in chunk], timeout=5)
+                if response.status_code == 200:
+                    answers = response.json()
+            except Exception as e:
+                logger.warning(f"Geo batch lookup failed for {len(chunk)} IPs: {e}")
+            self._store_batch(results, pending, chunk, answers)
+        
+        return self._finish_batch(results, pending)
+
+    def _make_result(self, data: Dict) -> Optional[Dict[str, str]]:
+        """Ответ ip-api.com -> информация о стране (None при неудаче)"""
+        if data.get('status') != 'success':
+            return None
+        country_code = data.get('countryCode', 'UN')
+        flag, known_name = self.country_data.get(country_code, ('🌍', 'Unknown'))
+        country_name = data.get('country', known_name)
+        return {
+            'country': country_name,
+            'code': country_code,
+            'flag': flag,
+            'name': country_name
+        }
+
     def get_flag_display(self, server: str) -> str:
         """Получить отображение с флагом для сервера"""
         info = self.get_country_info(server)
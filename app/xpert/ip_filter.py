@@ -1,116 +1,151 @@
+import base64
+import ipaddress
+import json
 import logging
 import re
-from typing import List, Set
-from urllib.parse import urlparse
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Set, Tuple
 from app.xpert.cluster_service import whitelist_service
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
+# Адрес между '@' и ':' (vless/trojan и декодированный ss)
+_ADDR_RE = re.compile(r'@([^:]+):')
+
+
+def _b64_pad(encoded: str) -> str:
+    return encoded + '=' * (-len(encoded) % 4)
+
+
+def _vless_like_address(config: str, body: str) -> str:
+    """VLESS/TROJAN: vless://uuid@ADDRESS:PORT?..."""
+    match = _ADDR_RE.search(config)
+    return match.group(1) if match else ""
+
+
+def _vmess_address(config: str, body: str) -> str:
+    """VMESS: vmess://BASE64(JSON)"""
+    # JSON разбирается прямо из bytes, без eval
+    return json_loads(base64.b64decode(body)).get('add', '')
+
+
+def _ss_address(config: str, body: str) -> str:
+    """Shadowsocks: ss://BASE64(method:password@ADDRESS:PORT)"""
+    decoded = base64.b64decode(_b64_pad(body.rstrip('/'))).decode('utf-8')
+    match = _ADDR_RE.search(decoded)
+    return match.group(1) if match else ""
+
+
+def _ssr_address(config: str, body: str) -> str:
+    """SSR: ssr://BASE64(ADDRESS:PORT:...)"""
+    parts = base64.urlsafe_b64decode(_b64_pad(body)).decode('utf-8').split(':')
+    return parts[0] if len(parts) >= 2 else ""
+
+
+_ADDRESS_HANDLERS = {
+    'vless': _vless_like_address,
+    'trojan': _vless_like_address,
+    'vmess': _vmess_address,
+    'ss': _ss_address,
+    'ssr': _ssr_address,
+}
+
+
+@lru_cache(maxsize=65536)
+def _extract_address(config: str) -> str:
+    """Извлекает address (IP или домен) из конфигурации; результат зависит только от строки"""
+    # Схема отделяется одним partition, обработчик выбирается по словарю
+    scheme, _, body = config.partition('://')
+    handler = _ADDRESS_HANDLERS.get(scheme)
+    if handler is not None:
+        try:
+            address = handler(config, body)
+            if address:
+                logger.debug(f"Extracted address {address} from {scheme} config")
+                return address
+        except Exception:
+            pass
+    
+    logger.warning(f"Could not extract address from config: {config[:50]}...")
+    return ""
+
+
+class _NetworkSet:
+    """IP и CIDR-диапазоны белого списка в виде int: проверка за одно обращение к set на каждую длину префикса"""
+    
+    def __init__(self, hosts: Iterable[str]):
+        # (версия IP, длина префикса) -> адреса сетей как int; отдельный IP - сеть /32 или /128
+        self._by_prefix: Dict[Tuple[int, int], Set[int]] = {}
+        for host in hosts:
+            try:
+                net = ipaddress.ip_network(host.strip('[]'), strict=False)
+            except ValueError:
+                # Домены сюда не попадают, предупреждаем только о битых диапазонах
+                if '/' in host:
+                    logger.warning(f"Invalid network in whitelist: {host}")
+                continue
+            self._by_prefix.setdefault((net.version, net.prefixlen), set()).add(int(net.network_address))
+    
+    def __bool__(self) -> bool:
+        return bool(self._by_prefix)
+    
+    def __contains__(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address.strip('[]'))
+        except ValueError:
+            return False
+        value = int(ip)
+        bits = ip.max_prefixlen
+        for (version, prefixlen), networks in self._by_prefix.items():
+            if version == ip.version and (value >> (bits - prefixlen)) << (bits - prefixlen) in networks:
+                return True
+        return False
+
+
 class HostFilter:
     """Фильтрует сервера по белому списку хостов (IP и домены)"""
     
     def __init__(self):
-        self.allowed_hosts: Set[str] = set()
+        self.allowed_hosts: FrozenSet[str] = frozenset()
+        # Версия белых списков, по которой построен allowed_hosts
+        self._hosts_version = -1
+        # IP и записи вида 10.0.0.0/8 из белого списка, сравниваются как числа
+        self._networks = _NetworkSet(())
     
     def update_allowed_hosts(self):
-        """Обновляет кэш разрешенных хостов"""
-        self.allowed_hosts = whitelist_service.get_all_allowed_hosts()
+        """Обновляет кэш разрешенных хостов, если белые списки изменились"""
+        if self._hosts_version == whitelist_service.version:
+            return
+        self._hosts_version = whitelist_service.version
+        self.allowed_hosts = whitelist_service.get_all_allowed_addresses()
+        self._networks = _NetworkSet(self.allowed_hosts)
         logger.info(f"Updated allowed hosts cache: {len(self.allowed_hosts)} hosts")
     
     def extract_address_from_config(self, config: str) -> str:
         """Извлекает address (IP или домен) из конфигурации"""
-        try:
-            # Пробуем разные форматы конфигов
-            
-            # VLESS/VLESS/TROJAN: vless://uuid@ADDRESS:PORT?...
-            if config.startswith(('vless://', 'trojan://')):
-                match = re.search(r'@([^:]+):', config)
-                if match:
-                    address = match.group(1)
-                    logger.debug(f"Extracted address {address} from VLESS/Trojan config")
-                    return address
-            
-            # VMESS: vmess://BASE64
-            elif config.startswith('vmess://'):
-                import base64
-                try:
-                    decoded = base64.b64decode(config[8:]).decode('utf-8')
-                    data = eval(decoded)  # В реальном коде нужно использовать json.loads
-                    address = data.get('add', '')
-                    if address:
-                        logger.debug(f"Extracted address {address} from VMESS config")
-                        return address
-                except:
-                    pass
-            
-            # Shadowsocks: ss://BASE64
-            elif config.startswith('ss://'):
-                import base64
-                try:
-                    # Убираем префикс и декодируем
-                    encoded = config[5:]
-                    if encoded.endswith('/'):
-                        encoded = encoded[:-1]
-                    
-                    # Добавляем padding если нужно
-                    padding_needed = len(encoded) % 4
-                    if padding_needed:
-                        encoded += '=' * (4 - padding_needed)
-                    
-                    decoded = base64.b64decode(encoded).decode('utf-8')
-                    
-                    # Формат: method:password@ADDRESS:PORT
-                    if '@' in decoded:
-                        match = re.search(r'@([^:]+):', decoded)
-                        if match:
-                            address = match.group(1)
-                            logger.debug(f"Extracted address {address} from SS config")
-                            return address
-                except:
-                    pass
-            
-            # SSR: ssr://BASE64
-            elif config.startswith('ssr://'):
-                import base64
-                try:
-                    encoded = config[6:]
-                    padding_needed = len(encoded) % 4
-                    if padding_needed:
-                        encoded += '=' * (4 - padding_needed)
-                    
-                    decoded = base64.urlsafe_b64decode(encoded).decode('utf-8')
-                    parts = decoded.split(':')
-                    if len(parts) >= 2:
-                        address = parts[0]
-                        logger.debug(f"Extracted address {address} from SSR config")
-                        return address
-                except:
-                    pass
-            
-            logger.warning(f"Could not extract address from config: {config[:50]}...")
-            return ""
-            
-        except Exception as e:
-            logger.error(f"Error extracting address from config: {e}")
-            return ""
+        return _extract_address(config)
     
     def is_address_allowed(self, address: str) -> bool:
         """Проверяет разрешен ли address (IP или домен)"""
         if not address:
             return False
         
-        # Обновляем кэш если пуст
-        if not self.allowed_hosts:
-            self.update_allowed_hosts()
+        # Обновляем кэш если белые списки изменились
+        self.update_allowed_hosts()
         
-        return address in self.allowed_hosts
+        return address in self.allowed_hosts or (bool(self._networks) and address in self._networks)
     
     def filter_servers(self, server_configs: List[str]) -> List[str]:
         """Фильтрует сервера, оставляя только с разрешенными адресами"""
         if not server_configs:
             return []
         
-        # Обновляем разрешенные хосты
+        # Пересобираем разрешенные хосты только после изменения белых списков
         self.update_allowed_hosts()
         
         if not self.allowed_hosts:
@@ -119,16 +154,20 @@ class HostFilter:
         
         logger.info(f"Filtering {len(server_configs)} servers against {len(self.allowed_hosts)} allowed hosts")
         
-        filtered_servers = []
+        # Локальные ссылки вместо обращений к атрибутам на каждый конфиг
+        allowed = self.allowed_hosts
+        networks = self._networks
+        extract = _extract_address
+        filtered_servers = [
+            config for config in server_configs
+            if (address := extract(config)) in allowed or (networks and address in networks)
+        ]
         
-        for config in server_configs:
-            address = self.extract_address_from_config(config)
-            
-            if self.is_address_allowed(address):
-                filtered_servers.append(config)
-                logger.info(f"✅ Allowed server: {address}")
-            else:
-                logger.info(f"❌ Blocked server: {address} (not in whitelist)")
+        if logger.isEnabledFor(logging.DEBUG):
+            for config in server_configs:
+                address = extract(config)
+                if not self.is_address_allowed(address):
+                    logger.debug(f"Blocked server: {address} (not in whitelist)")
         
         logger.info(f"Filtered result: {len(filtered_servers)}/{len(server_configs)} servers allowed")
         return filtered_servers
@@ -141,8 +180,11 @@ class HostFilter:
             'allowed_hosts_count': len(self.allowed_hosts),
             'allowed_hosts': list(self.allowed_hosts),
             'whitelists_count': len(whitelist_service.whitelists),
-            'whitelists_stats': whitelist_service.get_whitelist_stats()
+            'whitelists_stats': whitelist_service.get_whitelist_stats(),
+            'address_cache': _extract_address.cache_info()._asdict()
         }
 
 # Глобальный экземпляр
 host_filter = HostFilter()
+# Совместимость: отдельного фильтра по IP нет, IP проверяются тем же HostFilter
+ip_filter = host_filter
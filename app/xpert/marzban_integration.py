@@ -3,12 +3,14 @@
 Автоматическое добавление проверенных конфигураций в Marzban
 """
 
+import asyncio
 import logging
 from typing import List, Dict, Optional
+from sqlalchemy import and_, delete, true
 from sqlalchemy.orm import Session
 
-from app.db.crud import add_host, get_or_create_inbound
-from app.db.models import ProxyInbound, ProxyHost
+from app.db.crud import add_host, add_hosts, get_or_create_inbound
+from app.db.models import ProxyHost
 from app.models.proxy import ProxyHost as ProxyHostModify
 from app.xpert.models import AggregatedConfig
 from app.xpert.storage import storage
@@ -16,17 +18,19 @@ from app import db
 
 logger = logging.getLogger(__name__)
 
+# Размер части списка для NOT IN: держимся ниже лимита параметров SQLite
+_IN_CHUNK_SIZE = 500
+
+# Поля хоста, которые отличаются от значений по умолчанию для протокола
+_PROTOCOL_HOST_OVERRIDES = {
+    # Для Shadowsocks не нужен TLS
+    "shadowsocks": {"security": "none", "sni": "", "alpn": "", "fingerprint": ""},
+}
+
 
 class MarzbanIntegration:
     """Сервис интеграции с Marzban"""
     
-    def __init__(self):
-        self.db_session = db.SessionLocal()
-        
-    def __del__(self):
-        if hasattr(self, 'db_session'):
-            self.db_session.close()
-    
     def get_inbound_tag_for_config(self, config: AggregatedConfig) -> str:
         """Получение тега inbound для конкретного конфига"""
         protocol = config.protocol.lower()
@@ -60,24 +64,24 @@ class MarzbanIntegration:
             # Группируем по протоколам и портам
             configs_by_inbound = {}
             for config in active_configs:
-                inbound_tag = self.get_inbound_tag_for_config(config)
-                if inbound_tag not in configs_by_inbound:
-                    configs_by_inbound[inbound_tag] = []
-                configs_by_inbound[inbound_tag].append(config)
+                configs_by_inbound.setdefault(self.get_inbound_tag_for_config(config), []).append(config)
             
             synced_count = 0
             errors = []
             
-            # Обрабатываем каждый inbound
-            for inbound_tag, configs in configs_by_inbound.items():
-                try:
-                    result = self._sync_inbound_configs(inbound_tag, configs)
-                    synced_count += result["synced"]
-                    errors.extend(result.get("errors", []))
-                except Exception as e:
-                    error_msg = f"Failed to sync inbound {inbound_tag}: {str(e)}"
-                    logger.error(error_msg)
-                    errors.append(error_msg)
+            # Сессия открывается на время одной синхронизации
+            with db.GetDB() as db_session:
+                # Обрабатываем каждый inbound
+                for inbound_tag, configs in configs_by_inbound.items():
+                    try:
+                        result = self._sync_inbound_configs(db_session, inbound_tag, configs)
+                        synced_count += result["synced"]
+                        errors.extend(result.get("errors", []))
+                    except Exception as e:
+                        db_session.rollback()
+                        error_msg = f"Failed to sync inbound {inbound_tag}: {str(e)}"
+                        logger.error(error_msg)
+                        errors.append(error_msg)
             
             logger.info(f"Marzban sync complete: {synced_count} configs synced")
             
@@ -95,44 +99,61 @@ class MarzbanIntegration:
                 "error": str(e)
             }
     
-    def _sync_inbound_configs(self, inbound_tag: str, configs: List[AggregatedConfig]) -> Dict:
+    async def sync_active_configs_to_marzban_async(self) -> Dict:
+        """Синхронизация с Marzban в отдельном потоке, не блокируя event loop"""
+        return await asyncio.to_thread(self.sync_active_configs_to_marzban)
+    
+    def _sync_inbound_configs(self, db_session: Session, inbound_tag: str, configs: List[AggregatedConfig]) -> Dict:
         """Синхронизация конфигов для конкретного inbound"""
         # Получаем или создаем inbound
-        inbound = get_or_create_inbound(self.db_session, inbound_tag)
+        inbound = get_or_create_inbound(db_session, inbound_tag)
         
         # Получаем текущие хосты
         current_hosts = inbound.hosts or []
         current_addresses = {host.address for host in current_hosts}
         
-        # Определяем какие хосты добавить
-        new_addresses = set()
         synced_count = 0
         errors = []
         
+        # Новые хосты готовятся за один проход: каждый адрес добавляется один раз
+        new_hosts = []
         for config in configs:
-            if config.server not in current_addresses:
-                new_addresses.add(config.server)
+            if config.server in current_addresses:
+                continue
+            current_addresses.add(config.server)
+            try:
+                proxy_host = self.config_to_proxy_host(config)
+                
+                # Настраиваем параметры для разных протоколов
+                for field, value in _PROTOCOL_HOST_OVERRIDES.get(config.protocol.lower(), {}).items():
+                    setattr(proxy_host, field, value)
+                
+                new_hosts.append((config, proxy_host))
+                
+            except Exception as e:
+                error_msg = f"Failed to add host {config.server}: {str(e)}"
+                logger.error(error_msg)
+                errors.append(error_msg)
         
-        # Добавляем новые хосты
-        for config in configs:
-            if config.server in new_addresses:
+        if not new_hosts:
+            return {"synced": 0, "errors": errors}
+        
+        # Добавляем все хосты inbound одним коммитом
+        try:
+            add_hosts(db_session, inbound_tag, [host for _, host in new_hosts])
+            synced_count = len(new_hosts)
+            logger.info(f"Added {synced_count} hosts to {inbound_tag}")
+        except Exception as e:
+            # Пакет не прошел - добавляем по одному, чтобы сохранить корректные хосты
+            db_session.rollback()
+            logger.warning(f"Batch insert into {inbound_tag} failed, adding hosts one by one: {e}")
+            for config, proxy_host in new_hosts:
                 try:
-                    proxy_host = self.config_to_proxy_host(config)
-                    
-                    # Настраиваем параметры для разных протоколов
-                    if config.protocol.lower() == "shadowsocks":
-                        # Для Shadowsocks не нужен TLS
-                        proxy_host.security = "none"
-                        proxy_host.sni = ""
-                        proxy_host.alpn = ""
-                        proxy_host.fingerprint = ""
-                    
-                    # Добавляем хост
-                    add_host(self.db_session, inbound_tag, proxy_host)
+                    add_host(db_session, inbound_tag, proxy_host)
                     synced_count += 1
                     logger.info(f"Added {config.protocol} host: {config.server}:{config.port}")
-                    
                 except Exception as e:
+                    db_session.rollback()
                     error_msg = f"Failed to add host {config.server}: {str(e)}"
                     logger.error(error_msg)
                     errors.append(error_msg)
@@ -145,35 +166,21 @@ class MarzbanIntegration:
     def cleanup_inactive_hosts(self, active_configs: List[AggregatedConfig]) -> Dict:
         """Очистка неактивных хостов из Marzban"""
         try:
-            active_addresses = {config.server for config in active_configs}
-            removed_count = 0
-            errors = []
-            
-            # Получаем все inbound'ы
-            inbounds = self.db_session.query(ProxyInbound).all()
+            active_addresses = list({config.server for config in active_configs})
             
-            for inbound in inbounds:
-                if not inbound.hosts:
-                    continue
-                
-                # Удаляем неактивные хосты
-                hosts_to_keep = []
-                for host in inbound.hosts:
-                    if host.address in active_addresses:
-                        hosts_to_keep.append(host)
-                    else:
-                        try:
-                            self.db_session.delete(host)
-                            removed_count += 1
-                            logger.info(f"Removed inactive host: {host.address}")
-                        except Exception as e:
-                            error_msg = f"Failed to remove host {host.address}: {str(e)}"
-                            logger.error(error_msg)
-                            errors.append(error_msg)
-                
-                inbound.hosts = hosts_to_keep
-            
-            self.db_session.commit()
+            # Один DELETE вместо загрузки и удаления каждого хоста; длинный список делится на части
+            inactive = and_(*(
+                ProxyHost.address.notin_(active_addresses[i:i + _IN_CHUNK_SIZE])
+                for i in range(0, len(active_addresses), _IN_CHUNK_SIZE)
+            )) if active_addresses else true()
+            with db.GetDB() as db_session:
+                result = db_session.execute(
+                    delete(ProxyHost).where(inactive),
+                    execution_options={"synchronize_session": False}
+                )
+                db_session.commit()
+            removed_count = result.rowcount
+            errors = []
             
             logger.info(f"Cleanup complete: {removed_count} inactive hosts removed")
             
@@ -189,6 +196,10 @@ class MarzbanIntegration:
                 "status": "error",
                 "error": str(e)
             }
+    
+    async def cleanup_inactive_hosts_async(self, active_configs: List[AggregatedConfig]) -> Dict:
+        """Очистка неактивных хостов в отдельном потоке, не блокируя event loop"""
+        return await asyncio.to_thread(self.cleanup_inactive_hosts, active_configs)
 
 
 # Глобальный экземпляр интеграции
@@ -1,4 +1,4 @@
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import List, Optional
 
@@ -36,7 +36,18 @@ class UserPingStats:
         )
     
     def to_dict(self):
-        return asdict(self)
+        # Поля перечислены явно: asdict рекурсивно копирует значения и заметно медленнее
+        return {
+            'server': self.server,
+            'port': self.port,
+            'protocol': self.protocol,
+            'user_id': self.user_id,
+            'ping_ms': self.ping_ms,
+            'success_count': self.success_count,
+            'fail_count': self.fail_count,
+            'last_ping': self.last_ping,
+            'created_at': self.created_at
+        }
     
     @classmethod
     def from_dict(cls, data: dict):
@@ -56,7 +67,17 @@ class SubscriptionSource:
     created_at: str = field(default_factory=lambda: datetime.utcnow().isoformat())
     
     def to_dict(self):
-        return asdict(self)
+        return {
+            'id': self.id,
+            'name': self.name,
+            'url': self.url,
+            'enabled': self.enabled,
+            'priority': self.priority,
+            'last_fetched': self.last_fetched,
+            'config_count': self.config_count,
+            'success_rate': self.success_rate,
+            'created_at': self.created_at
+        }
     
     @classmethod
     def from_dict(cls, data: dict):
@@ -79,7 +100,20 @@ class AggregatedConfig:
     last_check: str = field(default_factory=lambda: datetime.utcnow().isoformat())
     
     def to_dict(self):
-        return asdict(self)
+        return {
+            'id': self.id,
+            'raw': self.raw,
+            'protocol': self.protocol,
+            'server': self.server,
+            'port': self.port,
+            'remarks': self.remarks,
+            'source_id': self.source_id,
+            'ping_ms': self.ping_ms,
+            'jitter_ms': self.jitter_ms,
+            'packet_loss': self.packet_loss,
+            'is_active': self.is_active,
+            'last_check': self.last_check
+        }
     
     @classmethod
     def from_dict(cls, data: dict):
@@ -2,68 +2,173 @@
 Сервис сбора и анализа статистики пингов от пользователей
 """
 
+import heapq
 import json
 import logging
+import os
+import sqlite3
+import threading
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional
 from collections import defaultdict
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 from app.xpert.models import UserPingStats, AggregatedConfig
 from app.xpert.storage import storage
 import config as app_config
 
 logger = logging.getLogger(__name__)
 
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_ping_stats (
+    server TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    protocol TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    ping_ms REAL NOT NULL,
+    success_count INTEGER NOT NULL DEFAULT 0,
+    fail_count INTEGER NOT NULL DEFAULT 0,
+    last_ping TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (server, port, protocol, user_id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_UPSERT_PING = """
+INSERT INTO user_ping_stats (server, port, protocol, user_id, ping_ms, success_count, fail_count, last_ping, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (server, port, protocol, user_id) DO UPDATE SET
+    success_count = success_count + excluded.success_count,
+    fail_count = fail_count + excluded.fail_count,
+    ping_ms = excluded.ping_ms,
+    last_ping = excluded.last_ping
+"""
+
 
 class PingStatsService:
     """Сервис управления статистикой пингов"""
     
     def __init__(self):
+        self.db_file = "xpert_ping_stats.db"
+        # Прежний JSON файл, переносится в базу при первом запуске
         self.stats_file = "xpert_ping_stats.json"
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(self.db_file, check_same_thread=False)
+        # WAL: запись пинга не блокирует чтение, а коммит не ждет fsync
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
         self.stats_data = self._load_stats()
+        # Запись по (server, port, protocol, user_id)
+        self._by_key: Dict[tuple, UserPingStats] = {}
+        # Накопленные итоги по (server, port, protocol), обновляются при каждом пинге
+        self._server_agg: Dict[tuple, Dict] = {}
+        self._rebuild_index()
     
     def _load_stats(self) -> Dict:
-        """Загрузка статистики из файла"""
+        """Загрузка статистики из базы (при первом запуске переносит JSON файл)"""
         try:
-            with open(self.stats_file, 'r') as f:
-                data = json.load(f)
-                return {
-                    'user_stats': [UserPingStats.from_dict(item) for item in data.get('user_stats', [])],
-                    'last_cleanup': data.get('last_cleanup', datetime.utcnow().isoformat())
-                }
-        except (FileNotFoundError, json.JSONDecodeError):
+            with self._db_lock:
+                if not self._db.execute("SELECT 1 FROM meta WHERE key = 'last_cleanup'").fetchone():
+                    self._migrate_json()
+                user_stats = [
+                    UserPingStats(
+                        server=row[0],
+                        port=row[1],
+                        protocol=row[2],
+                        user_id=row[3],
+                        ping_ms=row[4],
+                        success_count=row[5],
+                        fail_count=row[6],
+                        last_ping=row[7],
+                        created_at=row[8]
+                    )
+                    for row in self._db.execute(
+                        "SELECT server, port, protocol, user_id, ping_ms, success_count, fail_count, last_ping, created_at "
+                        "FROM user_ping_stats"
+                    )
+                ]
+                last_cleanup = self._db.execute("SELECT value FROM meta WHERE key = 'last_cleanup'").fetchone()
+            return {'user_stats': user_stats, 'last_cleanup': last_cleanup[0]}
+        except Exception as e:
+            logger.error(f"Failed to load ping stats: {e}")
             return {'user_stats': [], 'last_cleanup': datetime.utcnow().isoformat()}
     
-    def _save_stats(self):
-        """Сохранение статистики в файл"""
+    def _migrate_json(self):
+        """Однократный перенос статистики из JSON файла в базу"""
         try:
-            data = {
-                'user_stats': [stat.to_dict() for stat in self.stats_data['user_stats']],
-                'last_cleanup': self.stats_data['last_cleanup']
+            with open(self.stats_file, 'rb') as f:
+                data = _json_loads(f.read())
+        except FileNotFoundError:
+            data = None
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to read {self.stats_file}, starting empty: {e}")
+            data = None
+        
+        user_stats = [UserPingStats.from_dict(item) for item in data.get('user_stats', [])] if data else []
+        last_cleanup = (data or {}).get('last_cleanup', datetime.utcnow().isoformat())
+        with self._db:
+            self._db.executemany(_UPSERT_PING, [
+                (stat.server, stat.port, stat.protocol, stat.user_id, stat.ping_ms,
+                 stat.success_count, stat.fail_count, stat.last_ping, stat.created_at)
+                for stat in user_stats
+            ])
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_cleanup', ?)", (last_cleanup,))
+        if data is not None:
+            # Файл сохраняется как резервная копия и больше не читается
+            os.replace(self.stats_file, f"{self.stats_file}.migrated")
+            logger.info(f"Migrated {len(user_stats)} ping stats from {self.stats_file} to {self.db_file}")
+    
+    def _rebuild_index(self):
+        """Перестраивает индексы по текущему списку статистики"""
+        self._by_key = {}
+        self._server_agg = {}
+        for stat in self.stats_data['user_stats']:
+            self._index(stat)
+    
+    def _index(self, stat: UserPingStats):
+        self._by_key[(stat.server, stat.port, stat.protocol, stat.user_id)] = stat
+        agg = self._server_agg.get((stat.server, stat.port, stat.protocol))
+        if agg is None:
+            agg = self._server_agg[(stat.server, stat.port, stat.protocol)] = {
+                'success': 0, 'fail': 0, 'ping_sum': 0.0, 'count': 0, 'users': set()
             }
-            with open(self.stats_file, 'w') as f:
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            logger.error(f"Failed to save ping stats: {e}")
+        agg['success'] += stat.success_count
+        agg['fail'] += stat.fail_count
+        agg['ping_sum'] += stat.ping_ms
+        agg['count'] += 1
+        agg['users'].add(stat.user_id)
     
     def record_ping(self, server: str, port: int, protocol: str, user_id: int, 
                    ping_ms: float, success: bool):
         """Запись результата пинга от пользователя"""
         try:
+            now = datetime.utcnow().isoformat()
+            # Одна вставка с обновлением по первичному ключу вместо перезаписи всего файла
+            with self._db_lock, self._db:
+                self._db.execute(_UPSERT_PING, (
+                    server, port, protocol, user_id, ping_ms,
+                    1 if success else 0, 0 if success else 1, now, now
+                ))
+            
             # Ищем существующую статистику
-            existing_stat = None
-            for stat in self.stats_data['user_stats']:
-                if (stat.server == server and 
-                    stat.port == port and 
-                    stat.protocol == protocol and 
-                    stat.user_id == user_id):
-                    existing_stat = stat
-                    break
+            existing_stat = self._by_key.get((server, port, protocol, user_id))
             
             if existing_stat:
-                # Обновляем существующую статистику
+                # Обновляем существующую статистику и итоги сервера на разницу
+                agg = self._server_agg[(server, port, protocol)]
+                agg['ping_sum'] += ping_ms - existing_stat.ping_ms
+                agg['success' if success else 'fail'] += 1
                 existing_stat.ping_ms = ping_ms
-                existing_stat.last_ping = datetime.utcnow().isoformat()
+                existing_stat.last_ping = now
                 if success:
                     existing_stat.success_count += 1
                 else:
@@ -77,11 +182,13 @@ class PingStatsService:
                     user_id=user_id,
                     ping_ms=ping_ms,
                     success_count=1 if success else 0,
-                    fail_count=0 if success else 1
+                    fail_count=0 if success else 1,
+                    last_ping=now,
+                    created_at=now
                 )
                 self.stats_data['user_stats'].append(new_stat)
+                self._index(new_stat)
             
-            self._save_stats()
             logger.debug(f"Recorded ping: {server}:{port} - {ping_ms}ms - {'success' if success else 'fail'}")
             
         except Exception as e:
@@ -90,25 +197,23 @@ class PingStatsService:
     def get_server_health(self, server: str, port: int, protocol: str, 
                          min_users: int = 3) -> Dict:
         """Получение статистики здоровья сервера"""
-        server_stats = [
-            stat for stat in self.stats_data['user_stats']
-            if (stat.server == server and 
-                stat.port == port and 
-                stat.protocol == protocol)
-        ]
+        agg = self._server_agg.get((server, port, protocol))
+        if agg is None:
+            agg = {'success': 0, 'fail': 0, 'ping_sum': 0.0, 'count': 0, 'users': ()}
+        unique_users = len(agg['users'])
         
-        if len(server_stats) < min_users:
+        if agg['count'] < min_users:
             return {
                 'healthy': None,  # Недостаточно данных
                 'avg_ping': 999.0,
                 'success_rate': 0.0,
-                'total_pings': len(server_stats),
-                'unique_users': len(set(stat.user_id for stat in server_stats))
+                'total_pings': agg['count'],
+                'unique_users': unique_users
             }
         
-        # Агрегируем статистику
-        total_success = sum(stat.success_count for stat in server_stats)
-        total_fail = sum(stat.fail_count for stat in server_stats)
+        # Итоги уже накоплены при записи пингов
+        total_success = agg['success']
+        total_fail = agg['fail']
         total_pings = total_success + total_fail
         
         if total_pings == 0:
@@ -117,17 +222,17 @@ class PingStatsService:
                 'avg_ping': 999.0,
                 'success_rate': 0.0,
                 'total_pings': 0,
-                'unique_users': len(set(stat.user_id for stat in server_stats))
+                'unique_users': unique_users
             }
         
         success_rate = (total_success / total_pings) * 100
-        avg_ping = sum(stat.ping_ms for stat in server_stats) / len(server_stats)
+        avg_ping = agg['ping_sum'] / agg['count']
         
         # Проверяем здоровье
         healthy = (
             success_rate >= 70.0 and  # Минимум 70% успехов
             avg_ping <= 1000.0 and     # Максимум 1000мс пинг
-            len(set(stat.user_id for stat in server_stats)) >= min_users
+            unique_users >= min_users
         )
         
         return {
@@ -135,9 +240,21 @@ class PingStatsService:
             'avg_ping': avg_ping,
             'success_rate': success_rate,
             'total_pings': total_pings,
-            'unique_users': len(set(stat.user_id for stat in server_stats))
+            'unique_users': unique_users
         }
     
+    def _health_per_config(self, configs: List[AggregatedConfig], min_users: int) -> List[Dict]:
+        """Здоровье серверов для прохода по конфигам: одинаковые сервера считаются один раз"""
+        health_cache = {}
+        result = []
+        for config in configs:
+            key = (config.server, config.port, config.protocol)
+            health = health_cache.get(key)
+            if health is None:
+                health = health_cache[key] = self.get_server_health(*key, min_users)
+            result.append(health)
+        return result
+    
     def get_top_configs(self, configs: List[AggregatedConfig], limit: int = 10) -> List[AggregatedConfig]:
         """Получение топ-N конфигов на основе статистики"""
         import config as app_config
@@ -150,9 +267,7 @@ class PingStatsService:
         scored_configs = []
         min_users = app_config.XPERT_MIN_USERS_FOR_STATS
         
-        for config in configs:
-            health = self.get_server_health(config.server, config.port, config.protocol, min_users)
-            
+        for config, health in zip(configs, self._health_per_config(configs, min_users)):
             if health['healthy'] is None:
                 # Нет статистики - используем оригинальные метрики
                 if config.is_active:
@@ -169,9 +284,8 @@ class PingStatsService:
             if score > 0:
                 scored_configs.append((config, score))
         
-        # Сортируем по убыванию score и берем топ-N
-        scored_configs.sort(key=lambda x: x[1], reverse=True)
-        top_configs = [config for config, score in scored_configs[:limit]]
+        # Берем топ-N по убыванию score без сортировки всего списка
+        top_configs = [config for config, score in heapq.nlargest(limit, scored_configs, key=lambda x: x[1])]
         
         return top_configs
     
@@ -212,9 +326,7 @@ class PingStatsService:
         healthy_configs = []
         min_users = app_config.XPERT_MIN_USERS_FOR_STATS
         
-        for config in configs:
-            health = self.get_server_health(config.server, config.port, config.protocol, min_users)
-            
+        for config, health in zip(configs, self._health_per_config(configs, min_users)):
             # Если нет статистики, используем оригинальную проверку
             if health['healthy'] is None:
                 if config.is_active:  # Используем оригинальную проверку пинга
@@ -232,16 +344,20 @@ class PingStatsService:
     def cleanup_old_stats(self, days: int = 7):
         """Очистка старой статистики"""
         try:
-            cutoff_date = datetime.utcnow() - timedelta(days=days)
+            # Метки времени - ISO строки одного формата (utcnow), их порядок совпадает с хронологическим
+            cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
             original_count = len(self.stats_data['user_stats'])
             
+            last_cleanup = datetime.utcnow().isoformat()
+            with self._db_lock, self._db:
+                self._db.execute("DELETE FROM user_ping_stats WHERE created_at <= ?", (cutoff,))
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_cleanup', ?)", (last_cleanup,))
+            
             self.stats_data['user_stats'] = [
-                stat for stat in self.stats_data['user_stats']
-                if datetime.fromisoformat(stat.created_at) > cutoff_date
+                stat for stat in self.stats_data['user_stats'] if stat.created_at > cutoff
             ]
-            
-            self.stats_data['last_cleanup'] = datetime.utcnow().isoformat()
-            self._save_stats()
+            self._rebuild_index()
+            self.stats_data['last_cleanup'] = last_cleanup
             
             cleaned_count = original_count - len(self.stats_data['user_stats'])
             if cleaned_count > 0:
@@ -253,11 +369,9 @@ class PingStatsService:
     def get_stats_summary(self) -> Dict:
         """Получение сводной статистики"""
         total_stats = len(self.stats_data['user_stats'])
-        unique_servers = len(set(
-            (stat.server, stat.port, stat.protocol) 
-            for stat in self.stats_data['user_stats']
-        ))
-        unique_users = len(set(stat.user_id for stat in self.stats_data['user_stats']))
+        # Сервера и пользователи берутся из накопленных итогов, без прохода по всем записям
+        unique_servers = len(self._server_agg)
+        unique_users = len(set().union(*(agg['users'] for agg in self._server_agg.values())))
         
         return {
             'total_ping_records': total_stats,
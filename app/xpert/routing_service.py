@@ -1,11 +1,26 @@
 import json
 import base64
+import ipaddress
 import logging
+import time
 from typing import Dict, List
 from datetime import datetime
 
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from orjson import dumps as _json_dumps
+except ImportError:
+    def _json_dumps(data) -> bytes:
+        return json.dumps(data, separators=(',', ':')).encode()
+
 logger = logging.getLogger(__name__)
 
+ROUTING_PROFILE_TTL = 60  # секунд
+USER_REGION_TTL = 3600  # секунд
+USER_REGION_CACHE_SIZE = 10000
+
 class RoutingService:
     """Сервис для создания Happ routing профилей"""
     
@@ -36,26 +51,51 @@ class RoutingService:
                 'priority_countries': ['US', 'DE', 'NL', 'FR', 'GB']
             }
         }
+        # Множества стран для проверки принадлежности при фильтрации серверов
+        for profile in self.routing_profiles.values():
+            profile['countries_set'] = frozenset(profile['countries'])
+            profile['priority_countries_set'] = frozenset(profile['priority_countries'])
+        # (profile_key, отпечаток серверов) -> (время создания, base64 профиль)
+        self._profile_cache: Dict[tuple, tuple] = {}
+        # IP пользователя -> (время истечения, профиль)
+        self._region_cache: Dict[str, tuple] = {}
+        # Одна сессия с пулом соединений к ip-api.com вместо нового соединения на запрос
+        self._http = requests.Session()
+        self._http.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
     
     def create_routing_profile(self, profile_key: str, servers: List[Dict]) -> str:
         """Создает routing профиль для Happ"""
         if profile_key not in self.routing_profiles:
             profile_key = 'global'
         
+        fingerprint = hash(tuple(sorted((s.get('server', ''), s.get('port', 0)) for s in servers)))
+        cache_key = (profile_key, fingerprint)
+        cached = self._profile_cache.get(cache_key)
+        if cached and time.time() - cached[0] < ROUTING_PROFILE_TTL:
+            return cached[1]
+        
         profile_config = self.routing_profiles[profile_key]
         
         # Фильтруем сервера по стране
         filtered_servers = []
         priority_servers = []
         
+        # Страны серверов определяются одним пакетом
+        from app.xpert.geo_service import geo_service
+        geo_service.get_country_info_batch([server['server'] for server in servers if server.get('server')])
+        country_map = {
+            server.get('server', ''): self._get_server_country(server.get('server', ''))
+            for server in servers
+        }
+        
         for server in servers:
-            server_country = self._get_server_country(server.get('server', ''))
+            server_country = country_map[server.get('server', '')]
             
             if not profile_config['countries']:  # Global профиль
                 filtered_servers.append(server)
-            elif server_country in profile_config['countries']:
+            elif server_country in profile_config['countries_set']:
                 filtered_servers.append(server)
-                if server_country in profile_config['priority_countries']:
+                if server_country in profile_config['priority_countries_set']:
                     priority_servers.append(server)
         
         # Создаем routing конфигурацию
@@ -84,13 +124,19 @@ class RoutingService:
             "servers": {
                 "total": len(filtered_servers),
                 "priority": len(priority_servers),
-                "countries": list(set([self._get_server_country(s.get('server', '')) for s in filtered_servers]))
+                "countries": list({country_map[s.get('server', '')] for s in filtered_servers})
             }
         }
         
         # Конвертируем в Base64 для Happ
-        routing_json = json.dumps(routing_config, separators=(',', ':'))
-        routing_base64 = base64.b64encode(routing_json.encode()).decode()
+        routing_base64 = base64.b64encode(_json_dumps(routing_config)).decode('ascii')
+        
+        now = time.time()
+        self._profile_cache = {
+            key: value for key, value in self._profile_cache.items()
+            if now - value[0] < ROUTING_PROFILE_TTL
+        }
+        self._profile_cache[cache_key] = (now, routing_base64)
         
         logger.info(f"Created routing profile '{profile_config['name']}' with {len(filtered_servers)} servers")
         return routing_base64
@@ -110,10 +156,21 @@ class RoutingService:
             # Если IP неизвестен, используем глобальный профиль
             return 'global'
         
+        # Локальные и служебные адреса не геолоцируются
+        try:
+            if not ipaddress.ip_address(user_ip).is_global:
+                return 'global'
+        except ValueError:
+            return 'global'
+        
+        now = time.time()
+        cached = self._region_cache.get(user_ip)
+        if cached and cached[0] > now:
+            return cached[1]
+        
         try:
-            import requests
             # Используем бесплатный IP геолокационный сервис
-            response = requests.get(f"http://ip-api.com/json/{user_ip}", timeout=2)
+            response = self._http.get(f"http://ip-api.com/json/{user_ip}", timeout=2)
             if response.status_code == 200:
                 data = response.json()
                 country_code = data.get('countryCode', '').upper()
@@ -135,6 +192,13 @@ class RoutingService:
                 
                 profile = country_to_profile.get(country_code, 'global')
                 logger.info(f"Detected user region: {country_code} -> profile: {profile}")
+                if len(self._region_cache) >= USER_REGION_CACHE_SIZE:
+                    self._region_cache = {
+                        ip: value for ip, value in self._region_cache.items() if value[0] > now
+                    }
+                    if len(self._region_cache) >= USER_REGION_CACHE_SIZE:
+                        self._region_cache.clear()
+                self._region_cache[user_ip] = (now + USER_REGION_TTL, profile)
                 return profile
                 
         except Exception as e:
@@ -1,19 +1,83 @@
 import asyncio
 import logging
+import time
+from dataclasses import dataclass
 from typing import List, Dict, Optional
-from app.xpert.checker import ConfigChecker
+from app.xpert.checker import checker
 from app.xpert.cluster_service import cluster_service
+import config as app_config
 
 logger = logging.getLogger(__name__)
 
+# Время жизни списка проверочных целей (секунды)
+_TARGETS_CACHE_TTL = 30
+
+
+@dataclass(slots=True)
+class TargetResult:
+    """Результат проверки сервера через одну цель"""
+    target_ip: str
+    target_domain: str
+    ping: float
+    connection_time: float = 0.0
+    error: Optional[str] = None
+    
+    def to_dict(self) -> Dict:
+        if self.error is None:
+            return {
+                'target_ip': self.target_ip,
+                'target_domain': self.target_domain,
+                'ping': self.ping,
+                'connection_time': self.connection_time
+            }
+        return {
+            'target_ip': self.target_ip,
+            'target_domain': self.target_domain,
+            'error': self.error,
+            'ping': self.ping
+        }
+
 class ServerFilter:
     """Фильтрует сервера через проверочные цели"""
     
     def __init__(self):
-        self.checker = ConfigChecker()
+        # Общий экземпляр: кэши разбора, DNS и портов общие с обновлением подписок
+        self.checker = checker
+        self._targets: List = []
+        # Описания целей для get_filter_stats, строятся при обновлении списка целей
+        self._targets_info: List[Dict] = []
+        self._targets_time = 0.0
     
-    async def test_server_through_targets(self, server_config: str, test_targets: List) -> Dict:
-        """Проверяет работает ли сервер через проверочные цели"""
+    def _get_test_targets(self) -> List:
+        """Активные проверочные цели с кэшированием на _TARGETS_CACHE_TTL"""
+        now = time.monotonic()
+        if not self._targets_time or now - self._targets_time > _TARGETS_CACHE_TTL:
+            self._targets = cluster_service.get_active_test_targets()
+            self._targets_info = [
+                {
+                    'ip': t.ip,
+                    'domain': t.domain,
+                    'country': t.country,
+                    'description': t.description
+                }
+                for t in self._targets
+            ]
+            self._targets_time = now
+        return self._targets
+    
+    def _target_ping(self, target_ip: str, target_pings: Optional[dict]) -> asyncio.Future:
+        """Пинг цели; с общим словарем target_pings каждая цель пингуется один раз за проход"""
+        if target_pings is None:
+            return asyncio.ensure_future(self._ping_target_directly(target_ip))
+        future = target_pings.get(target_ip)
+        if future is None:
+            future = target_pings[target_ip] = asyncio.ensure_future(self._ping_target_directly(target_ip))
+        return future
+    
+    async def test_server_through_targets(self, server_config: str, test_targets: List,
+                                          min_working: int = 1, min_ping_samples: int = 3,
+                                          target_pings: Optional[dict] = None) -> Dict:
+        """Проверяет работает ли сервер через проверочные цели (до min_working рабочих целей и min_ping_samples замеров)"""
         results = {
             'server': server_config,
             'working_targets': [],
@@ -29,64 +93,78 @@ class ServerFilter:
             logger.warning(f"Failed to parse server config: {server_config}")
             return results
         
-        logger.info(f"Testing server {server_ip}:{port} against {len(test_targets)} targets")
+        logger.debug("Testing server %s:%s against %d targets", server_ip, port, len(test_targets))
         
         working_count = 0
         total_ping = 0.0
         
+        # Доступность сервера одна для всех целей - проверяем один раз
+        try:
+            is_connected, connection_time = await self.checker.check_connectivity(server_ip, port)
+        except Exception as e:
+            is_connected, connection_time, error = False, 0.0, str(e)
+        else:
+            error = 'Server not reachable'
+        
+        if not is_connected:
+            results['failed_targets'] = [
+                TargetResult(target.ip, target.domain, 999.0, error=error)
+                for target in test_targets
+            ]
+            logger.debug("Server %s working: False, working targets: 0/%d", server_ip, len(test_targets))
+            return results
+        
+        # Если сервер доступен, проверяем пинг до целей через сервер
+        # Это упрощенная проверка - в реальности нужно проксирование через сервер
+        # Но для начала проверим просто доступность сервера и пинг до цели напрямую
+        # Цели независимы - пингуем их одновременно; когда рабочих целей достаточно, остальные отменяются
+        ping_tasks = {}
         for target in test_targets:
-            try:
-                # Проверяем доступность сервера
-                is_connected, connection_time = await self.checker.check_connectivity(server_ip, port)
-                
-                if not is_connected:
-                    results['failed_targets'].append({
-                        'target_ip': target.ip,
-                        'target_domain': target.domain,
-                        'error': 'Server not reachable',
-                        'ping': 999.0
-                    })
-                    continue
-                
-                # Если сервер доступен, проверяем пинг до цели через сервер
-                # Это упрощенная проверка - в реальности нужно проксирование через сервер
-                # Но для начала проверим просто доступность сервера и пинг до цели напрямую
-                
-                ping_result = await self._ping_target_directly(target.ip)
-                
-                if ping_result < 1000:  # Если пинг до цели хороший
-                    working_count += 1
-                    total_ping += ping_result
-                    results['working_targets'].append({
-                        'target_ip': target.ip,
-                        'target_domain': target.domain,
-                        'ping': ping_result,
-                        'connection_time': connection_time
-                    })
-                    logger.debug(f"Server {server_ip} can reach target {target.ip} with ping {ping_result}ms")
-                else:
-                    results['failed_targets'].append({
-                        'target_ip': target.ip,
-                        'target_domain': target.domain,
-                        'error': f'High ping to target: {ping_result}ms',
-                        'ping': ping_result
-                    })
+            ping_tasks.setdefault(self._target_ping(target.ip, target_pings), []).append(target)
+        pending = set(ping_tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        ping_result, error = task.result(), None
+                    except Exception as e:
+                        ping_result, error = 999.0, str(e)
                     
-            except Exception as e:
-                results['failed_targets'].append({
-                    'target_ip': target.ip,
-                    'target_domain': target.domain,
-                    'error': str(e),
-                    'ping': 999.0
-                })
-                logger.debug(f"Error testing server {server_ip} against target {target.ip}: {e}")
+                    for target in ping_tasks[task]:
+                        if error is not None:
+                            results['failed_targets'].append(
+                                TargetResult(target.ip, target.domain, 999.0, error=error)
+                            )
+                            logger.debug("Error testing server %s against target %s: %s", server_ip, target.ip, error)
+                        elif ping_result < 1000:  # Если пинг до цели хороший
+                            working_count += 1
+                            total_ping += ping_result
+                            results['working_targets'].append(
+                                TargetResult(target.ip, target.domain, ping_result, connection_time)
+                            )
+                            logger.debug("Server %s can reach target %s with ping %sms", server_ip, target.ip, ping_result)
+                        else:
+                            results['failed_targets'].append(
+                                TargetResult(target.ip, target.domain, ping_result,
+                                             error=f'High ping to target: {ping_result}ms')
+                            )
+                
+                if working_count >= max(min_working, min_ping_samples):
+                    break
+        finally:
+            # Общие пинги нужны другим серверам прохода, их отменяет filter_servers
+            if target_pings is None:
+                for task in pending:
+                    task.cancel()
         
         # Определяем работает ли сервер
         results['is_working'] = working_count > 0
         if working_count > 0:
             results['avg_ping'] = total_ping / working_count
         
-        logger.info(f"Server {server_ip} working: {results['is_working']}, working targets: {working_count}/{len(test_targets)}")
+        logger.debug("Server %s working: %s, working targets: %d/%d",
+                    server_ip, results['is_working'], working_count, len(test_targets))
         return results
     
     async def _ping_target_directly(self, target_ip: str) -> float:
@@ -95,16 +173,16 @@ class ServerFilter:
             ping, jitter, loss = await self.checker.check_ping(target_ip)
             return ping
         except Exception as e:
-            logger.debug(f"Failed to ping target {target_ip}: {e}")
+            logger.debug("Failed to ping target %s: %s", target_ip, e)
             return 999.0
     
-    async def filter_servers(self, server_configs: List[str]) -> List[str]:
+    async def filter_servers(self, server_configs: List[str], concurrency: int = 64) -> List[str]:
         """Фильтрует сервера, оставляя только рабочие"""
         if not server_configs:
             return []
         
         # Получаем проверочные цели
-        test_targets = cluster_service.get_active_test_targets()
+        test_targets = self._get_test_targets()
         
         if not test_targets:
             logger.warning("No test targets found, returning all servers")
@@ -112,46 +190,76 @@ class ServerFilter:
         
         logger.info(f"Filtering {len(server_configs)} servers against {len(test_targets)} test targets")
         
-        working_servers = []
+        # Проверяем сервера параллельно, ограничивая число одновременных проверок
+        semaphore = asyncio.Semaphore(concurrency)
         
-        # Проверяем сервера параллельно
-        tasks = []
-        for config in server_configs:
-            task = self.test_server_through_targets(config, test_targets)
-            tasks.append(task)
+        # Пинг цели не зависит от сервера: за проход каждая цель пингуется один раз
+        target_pings = {}
         
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        async def test_bounded(config: str) -> Dict:
+            async with semaphore:
+                return await self.test_server_through_targets(config, test_targets, target_pings=target_pings)
         
-        for i, result in enumerate(results):
-            if isinstance(result, Exception):
-                logger.error(f"Error testing server {i}: {result}")
-                continue
-            
-            if result['is_working']:
-                working_servers.append(result['server'])
-                logger.info(f"✅ Server working: {result['server'][:50]}...")
-            else:
-                logger.info(f"❌ Server not working: {result['server'][:50]}...")
+        # Конфиги без адреса или порта отсеиваются до запуска проверок (разбор кэширован в checker)
+        valid_configs = [config for config in server_configs if all(self.checker.parse_config(config)[1:3])]
+        skipped_count = len(server_configs) - len(valid_configs)
+        if skipped_count:
+            logger.info(f"Skipping {skipped_count} unparseable server configs")
         
-        logger.info(f"Filtered {len(server_configs)} -> {len(working_servers)} working servers")
+        tasks = [asyncio.ensure_future(test_bounded(config)) for config in valid_configs]
+        working = set()
+        checked_count = 0
+        not_working_count = 0
+        error_count = 0
+        try:
+            # Результаты разбираются по мере готовности; общий срок не дает одному зависшему серверу задержать всех
+            async with asyncio.timeout(app_config.XPERT_FILTER_DEADLINE or None):
+                for next_result in asyncio.as_completed(tasks):
+                    try:
+                        result = await next_result
+                    except Exception as e:
+                        checked_count += 1
+                        error_count += 1
+                        logger.error(f"Error testing server: {e}")
+                        continue
+                    checked_count += 1
+                    
+                    # Статус каждого сервера - только на уровне DEBUG, итог - одной строкой
+                    if result['is_working']:
+                        working.add(result['server'])
+                        logger.debug("✅ Server working: %.50s...", result['server'])
+                    else:
+                        not_working_count += 1
+                        logger.debug("❌ Server not working: %.50s...", result['server'])
+        except TimeoutError:
+            logger.warning(
+                f"Server filtering deadline of {app_config.XPERT_FILTER_DEADLINE}s reached, "
+                f"{len(tasks) - checked_count} servers left unchecked"
+            )
+        finally:
+            for task in tasks:
+                task.cancel()
+            for future in target_pings.values():
+                future.cancel()
+        
+        # Порядок рабочих серверов - как во входном списке
+        working_servers = [config for config in valid_configs if config in working]
+        
+        logger.info(
+            f"Filtered {len(server_configs)} -> {len(working_servers)} working servers "
+            f"({not_working_count} not working, {error_count} errors, "
+            f"{skipped_count} unparseable, {len(tasks) - checked_count} unchecked)"
+        )
         return working_servers
     
     def get_filter_stats(self, server_configs: List[str]) -> Dict:
         """Получает статистику фильтрации"""
-        test_targets = cluster_service.get_active_test_targets()
+        test_targets = self._get_test_targets()
         
         return {
             'total_servers': len(server_configs),
             'test_targets_count': len(test_targets),
-            'test_targets': [
-                {
-                    'ip': t.ip,
-                    'domain': t.domain,
-                    'country': t.country,
-                    'description': t.description
-                }
-                for t in test_targets
-            ]
+            'test_targets': self._targets_info
         }
 
 # Глобальный экземпляр
@@ -1,6 +1,7 @@
 import asyncio
 import base64
 import logging
+import threading
 from datetime import datetime
 from typing import List, Optional
 
@@ -16,6 +17,12 @@ logger = logging.getLogger(__name__)
 class XpertService:
     """Сервис агрегации подписок"""
     
+    def __init__(self):
+        # Готовые подписки: формат -> (версия конфигов, содержимое)
+        self._subscription_cache = {}
+        # generate_subscription_async строит подписку в потоках, параллельно с обновлением конфигов
+        self._subscription_lock = threading.Lock()
+    
     def add_source(self, name: str, url: str, priority: int = 1) -> SubscriptionSource:
         """Добавление источника подписки"""
         return storage.add_source(name, url, priority)
@@ -44,6 +51,33 @@ class XpertService:
         """Получение всех конфигураций"""
         return storage.get_configs()
     
+    async def _process_source(self, source: SubscriptionSource) -> Optional[List[dict]]:
+        """Загрузка и проверка конфигов одного источника"""
+        try:
+            logger.info(f"Fetching configs from: {source.name} ({source.url})")
+            # Конфиги обрабатываются по мере загрузки подписки
+            fetched_count, results = await checker.fetch_and_process(source.url)
+            logger.info(f"Fetched {fetched_count} raw configs from {source.name}")
+            
+            source.last_fetched = datetime.utcnow().isoformat()
+            source.config_count = fetched_count
+            results = [result for result in results if result]
+            
+            source.success_rate = 100.0  # Все конфиги активные
+            storage.update_source(source)
+            
+            source_active = sum(1 for result in results if result["is_active"])
+            logger.info(f"Source {source.name}: {source_active}/{fetched_count} configs added")
+            return results
+            
+        except Exception as e:
+            logger.error(f"Failed to process source {source.name}: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            source.success_rate = 0
+            storage.update_source(source)
+            return None
+    
     async def update_subscription(self) -> dict:
         """Обновление всех подписок"""
         sources = self.get_enabled_sources()
@@ -57,62 +91,44 @@ class XpertService:
         active_configs = 0
         config_id = 1
         
-        for source in sources:
-            try:
-                logger.info(f"Fetching configs from: {source.name} ({source.url})")
-                raw_configs = await checker.fetch_subscription(source.url)
-                logger.info(f"Fetched {len(raw_configs)} raw configs from {source.name}")
-                
-                source.last_fetched = datetime.utcnow().isoformat()
-                source.config_count = len(raw_configs)
-                
-                source_active = 0
-                for raw in raw_configs:
-                    result = await checker.process_config(raw)
-                    if result:
-                        config_obj = AggregatedConfig(
-                            id=config_id,
-                            raw=result["raw"],
-                            protocol=result["protocol"],
-                            server=result["server"],
-                            port=result["port"],
-                            remarks=result["remarks"],
-                            source_id=source.id,
-                            ping_ms=result["ping_ms"],
-                            jitter_ms=result["jitter_ms"],
-                            packet_loss=result["packet_loss"],
-                            is_active=result["is_active"],
-                            last_check=datetime.utcnow().isoformat()
-                        )
-                        all_configs.append(config_obj)
-                        config_id += 1
-                        total_configs += 1
-                        if result["is_active"]:
-                            active_configs += 1
-                            source_active += 1
-                
-                source.success_rate = 100.0  # Все конфиги активные
-                storage.update_source(source)
-                
-                logger.info(f"Source {source.name}: {source_active}/{len(raw_configs)} configs added")
-                
-            except Exception as e:
-                logger.error(f"Failed to process source {source.name}: {e}")
-                import traceback
-                logger.error(traceback.format_exc())
-                source.success_rate = 0
-                storage.update_source(source)
+        # Источники независимы - загружаются и проверяются одновременно
+        source_results = await asyncio.gather(*(self._process_source(source) for source in sources))
+        
+        # Номера конфигов назначаются после загрузки в порядке источников
+        for source, results in zip(sources, source_results):
+            for result in results or ():
+                config_obj = AggregatedConfig(
+                    id=config_id,
+                    raw=result["raw"],
+                    protocol=result["protocol"],
+                    server=result["server"],
+                    port=result["port"],
+                    remarks=result["remarks"],
+                    source_id=source.id,
+                    ping_ms=result["ping_ms"],
+                    jitter_ms=result["jitter_ms"],
+                    packet_loss=result["packet_loss"],
+                    is_active=result["is_active"],
+                    last_check=datetime.utcnow().isoformat()
+                )
+                all_configs.append(config_obj)
+                config_id += 1
+                total_configs += 1
+                if result["is_active"]:
+                    active_configs += 1
         
-        storage.save_configs(all_configs)
+        # Без изменений файл не перезаписывается, и готовые подписки остаются в кэше
+        if not storage.update_configs(all_configs):
+            logger.info("Configs unchanged since last update, keeping stored configs")
         logger.info(f"Subscription update complete: {active_configs}/{total_configs} active configs")
         
         # Синхронизация с Marzban
         try:
-            sync_result = marzban_integration.sync_active_configs_to_marzban()
+            sync_result = await marzban_integration.sync_active_configs_to_marzban_async()
             logger.info(f"Marzban sync result: {sync_result}")
             
             # Очистка неактивных хостов
-            cleanup_result = marzban_integration.cleanup_inactive_hosts(all_configs)
+            cleanup_result = await marzban_integration.cleanup_inactive_hosts_async(all_configs)
             logger.info(f"Marzban cleanup result: {cleanup_result}")
             
         except Exception as e:
@@ -120,15 +136,44 @@ class XpertService:
         
         return {"active_configs": active_configs, "total_configs": total_configs}
     
+    def _cached_subscription(self, format: str, version: int) -> Optional[str]:
+        """Готовая подписка из кэша, если она построена из указанной версии конфигов"""
+        cached = self._subscription_cache.get(format)
+        if cached and cached[0] == version:
+            return cached[1]
+        return None
+    
     def generate_subscription(self, format: str = "universal") -> str:
         """Генерация подписки в указанном формате"""
-        configs = self.get_active_configs()
+        if format != "base64":
+            format = "universal"
+        
+        content = self._cached_subscription(format, storage.configs_version)
+        if content is not None:
+            return content
         
-        if format == "base64":
-            content = "\n".join([c.raw for c in configs])
-            return base64.b64encode(content.encode()).decode()
-        else:
-            return "\n".join([c.raw for c in configs])
+        # Одновременные промахи кэша строят подписку один раз
+        with self._subscription_lock:
+            # Версия читается до загрузки конфигов: storage увеличивает ее только после записи файла
+            version = storage.configs_version
+            content = self._cached_subscription(format, version)
+            if content is None:
+                configs = self.get_active_configs()
+                if format == "base64":
+                    content = base64.b64encode(b"\n".join(c.raw.encode() for c in configs)).decode('ascii')
+                else:
+                    content = "\n".join(c.raw for c in configs)
+                self._subscription_cache[format] = (version, content)
+        return content
+    
+    async def generate_subscription_async(self, format: str = "universal") -> str:
+        """Генерация подписки без блокировки event loop: загрузка и кодирование выполняются в потоке"""
+        content = self._cached_subscription(
+            "base64" if format == "base64" else "universal", storage.configs_version
+        )
+        if content is not None:
+            return content
+        return await asyncio.to_thread(self.generate_subscription, format)
     
     def get_stats(self) -> dict:
         """Получение статистики"""
@@ -6,6 +6,19 @@ from datetime import datetime
 
 from app.xpert.models import SubscriptionSource, AggregatedConfig
 
+try:
+    import orjson
+
+    def _json_dumps(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+    _json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
 DATA_DIR = os.environ.get("XPERT_DATA_DIR", "/var/lib/marzban/xpert")
@@ -18,6 +31,8 @@ class XpertStorage:
         self.data_dir = DATA_DIR
         self.sources_file = os.path.join(self.data_dir, "sources.json")
         self.configs_file = os.path.join(self.data_dir, "configs.json")
+        # Номер версии конфигов растет при каждой записи
+        self.configs_version = 0
         self._ensure_data_dir()
     
     def _ensure_data_dir(self):
@@ -35,8 +50,8 @@ class XpertStorage:
         """Загрузка JSON файла"""
         if os.path.exists(filepath):
             try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with open(filepath, 'rb') as f:
+                    return _json_loads(f.read())
             except Exception as e:
                 logger.error(f"Failed to load {filepath}: {e}")
         return []
@@ -44,8 +59,11 @@ class XpertStorage:
     def _save_json(self, filepath: str, data: list):
         """Сохранение JSON файла"""
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            # Пишем во временный файл и атомарно подменяем, чтобы не оставить файл обрезанным
+            tmp_file = f"{filepath}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(_json_dumps(data))
+            os.replace(tmp_file, filepath)
         except Exception as e:
             logger.error(f"Failed to save {filepath}: {e}")
     
@@ -119,10 +137,24 @@ class XpertStorage:
     def save_configs(self, configs: List[AggregatedConfig]):
         """Сохранение всех конфигов"""
         self._save_json(self.configs_file, [c.to_dict() for c in configs])
+        self.configs_version += 1
+    
+    def update_configs(self, configs: List[AggregatedConfig]) -> bool:
+        """Сохранение конфигов только если они изменились (время проверки не сравнивается)"""
+        def fields(config: AggregatedConfig) -> dict:
+            data = config.to_dict()
+            del data['last_check']
+            return data
+        
+        if [fields(c) for c in self.get_configs()] == [fields(c) for c in configs]:
+            return False
+        self.save_configs(configs)
+        return True
     
     def clear_configs(self):
         """Очистка конфигов"""
         self._save_json(self.configs_file, [])
+        self.configs_version += 1
     
     def get_stats(self) -> dict:
         """Получение статистики"""
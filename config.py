@@ -136,6 +136,11 @@ SUB_UPDATE_INTERVAL = config("SUB_UPDATE_INTERVAL", default="12")
 SUB_SUPPORT_URL = config("SUB_SUPPORT_URL", default="https://t.me/")
 SUB_PROFILE_TITLE = config("SUB_PROFILE_TITLE", default="Subscription")
 
+# how long a generated subscription is reused for repeated pulls, in seconds (0 disables)
+SUB_CACHE_TTL = config("SUB_CACHE_TTL", cast=int, default=30)
+# maximum number of generated subscriptions kept in the cache
+SUB_CACHE_MAX_ENTRIES = config("SUB_CACHE_MAX_ENTRIES", cast=int, default=1024)
+
 # discord webhook log
 DISCORD_WEBHOOK_URL = config("DISCORD_WEBHOOK_URL", default="")
 
@@ -160,4 +165,8 @@ XPERT_USE_DYNAMIC_FILTERING = config("XPERT_USE_DYNAMIC_FILTERING", cast=bool, d
 XPERT_MIN_USERS_FOR_STATS = config("XPERT_MIN_USERS_FOR_STATS", cast=int, default=3)
 XPERT_TOP_SERVERS_LIMIT = config("XPERT_TOP_SERVERS_LIMIT", cast=int, default=1000)  # Убираем лимит
 XPERT_USE_COUNTRY_FLAGS = config("XPERT_USE_COUNTRY_FLAGS", cast=bool, default=True)
+# Путь к GeoLite2-Country.mmdb: страны определяются локально, ip-api.com остается запасным вариантом
+XPERT_GEOIP_DB = config("XPERT_GEOIP_DB", default="")
+# Общий срок фильтрации серверов через проверочные цели (секунды, 0 - без ограничения)
+XPERT_FILTER_DEADLINE = config("XPERT_FILTER_DEADLINE", cast=int, default=300)
 JOB_SUBSCRIPTION_AGGREGATION_INTERVAL = config("JOB_SUBSCRIPTION_AGGREGATION_INTERVAL", cast=int, default=3600)